@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of parse_nvidia_xml against nvidia-smi output (see fixtures/). The fixtures are synthesized in the
+layout of `nvidia-smi -q -x`, they are not recordings of real devices: UUIDs, serials and process lists are made up.
+
+Compares the incremental parser of device_query with the previous implementation that built the complete element
+tree, checks that both return the same data and reports parse time and peak memory usage of both.
+
+Usage: python3 benchmark_parser.py [-n <repetitions>]
+"""
+import argparse
+import glob
+import os
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import device_query
+
+
+def parse_nvidia_xml_tree(xml):
+    # previous implementation of device_query.parse_nvidia_xml, kept as the baseline of this benchmark
+    gpu_data = []
+    root = ET.fromstring(xml)
+
+    for gpu in root.iter('gpu'):
+        current_gpu_data = {
+            "name": gpu.find("product_name").text,
+            "uuid": gpu.find("uuid").text,
+        }
+
+        memory_usage = gpu.find("fb_memory_usage")
+        memory = {
+            "total": memory_usage.find("total").text,
+            "used": memory_usage.find("used").text,
+            "free": memory_usage.find("free").text,
+        }
+
+        process_block = gpu.find("processes")
+        if process_block.text == "N/A":
+            current_gpu_data["in_use"] = "na"
+        else:
+            current_gpu_data["in_use"] = "no"
+            current_gpu_data["processes"] = []
+            for process in process_block.iter("process_info"):
+                if process.find('type').text.lower() == "c":
+                    current_gpu_data["in_use"] = "yes"
+                    pid = process.find('pid').text
+                    process_info = {
+                        "pid": pid,
+                        "username": device_query.owner(pid),
+                        "name": process.find("process_name").text,
+                        "used_memory": process.find("used_memory").text,
+                    }
+                    current_gpu_data["processes"].append(process_info)
+        current_gpu_data["memory"] = memory
+        gpu_data.append(current_gpu_data)
+    return gpu_data
+
+
+def peak_memory(function, xml):
+    tracemalloc.start()
+    function(xml)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the nvidia-smi XML parser of device_query")
+    parser.add_argument("-n", "--repetitions", type=int, default=200, help="number of parses per measurement")
+    args = parser.parse_args()
+
+    # only measure parsing, looking up the owner of a process depends on the processes running on this machine
+    device_query.owner = lambda pid: "user"
+
+    fixtures = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "*.xml")))
+    print("{:<40} {:>8} {:>22} {:>22}".format("fixture", "size", "time per parse (ms)", "peak memory (KiB)"))
+    print("{:<40} {:>8} {:>10} {:>11} {:>10} {:>11}".format("", "(KiB)", "tree", "iterparse", "tree", "iterparse"))
+    for fixture in fixtures:
+        with open(fixture, "rb") as f:
+            xml = f.read()
+
+        if parse_nvidia_xml_tree(xml) != device_query.parse_nvidia_xml(xml):
+            raise AssertionError("parsers disagree on {}".format(fixture))
+
+        times = [
+            min(timeit.repeat(lambda: function(xml), number=args.repetitions, repeat=3)) / args.repetitions * 1000
+            for function in (parse_nvidia_xml_tree, device_query.parse_nvidia_xml)
+        ]
+        peaks = [peak_memory(function, xml) / 1024 for function in (parse_nvidia_xml_tree, device_query.parse_nvidia_xml)]
+        print("{:<40} {:>8.0f} {:>10.2f} {:>11.2f} {:>10.0f} {:>11.0f}".format(
+            os.path.basename(fixture), len(xml) / 1024, times[0], times[1], peaks[0], peaks[1]
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,59 +1,292 @@
 import argparse
+import gzip
+import hashlib
+import io
 import subprocess
+import sys
+import threading
+import time
+import urllib.request
 import xml.etree.ElementTree as ET
 import os
 import pwd
 import re
 import json
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
 
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
-class DeviceQueryHandler(BaseHTTPRequestHandler):
 
-    def parse_nvidia_xml(self, xml):
-        gpu_data = []
-        root = ET.fromstring(xml)
-
-        for gpu in root.iter('gpu'):
-            current_gpu_data = {
-                "name": gpu.find("product_name").text,
-                "uuid": gpu.find("uuid").text,
-            }
-
-            memory_usage = gpu.find("fb_memory_usage")
-            memory = {
-                "total": memory_usage.find("total").text,
-                "used": memory_usage.find("used").text,
-                "free": memory_usage.find("free").text,
-            }
-
-            process_block = gpu.find("processes")
-            if process_block.text == "N/A":
-                current_gpu_data["in_use"] = "na"
-            else:
-                current_gpu_data["in_use"] = "no"
-                current_gpu_data["processes"] = []
-                for process in process_block.iter("process_info"):
-                    if process.find('type').text.lower() == "c":
-                        current_gpu_data["in_use"] = "yes"
-                        pid = process.find('pid').text
-                        process_info = {
-                            "pid": pid,
-                            "username": self.owner(pid),
-                            "name": process.find("process_name").text,
-                            "used_memory": process.find("used_memory").text,
-                        }
-                        current_gpu_data["processes"].append(process_info)
-            current_gpu_data["memory"] = memory
-            gpu_data.append(current_gpu_data)
-        return gpu_data
+def parse_nvidia_xml(xml):
+    """
+    Extracts name, uuid, memory usage and compute processes of every GPU from the XML output of nvidia-smi.
 
-    def owner(self, pid):
+    The XML is parsed incrementally and every GPU element is discarded right after it has been handled, so that only
+    the subtree of a single GPU, which is mostly made up of fields we ignore (clocks, ECC errors, ...), is kept in
+    memory at any time.
+    """
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+
+    gpu_data = []
+    for _, gpu in ET.iterparse(io.BytesIO(xml), events=("end",)):
+        if gpu.tag != "gpu":
+            continue
+
+        current_gpu_data = {
+            "name": gpu.findtext("product_name"),
+            "uuid": gpu.findtext("uuid"),
+        }
+
+        memory_usage = gpu.find("fb_memory_usage")
+        memory = {
+            "total": memory_usage.findtext("total"),
+            "used": memory_usage.findtext("used"),
+            "free": memory_usage.findtext("free"),
+        }
+
+        process_block = gpu.find("processes")
+        if process_block.text == "N/A":
+            current_gpu_data["in_use"] = "na"
+        else:
+            current_gpu_data["in_use"] = "no"
+            current_gpu_data["processes"] = []
+            for process in process_block.iter("process_info"):
+                if process.findtext('type').lower() == "c":
+                    current_gpu_data["in_use"] = "yes"
+                    pid = process.findtext('pid')
+                    process_info = {
+                        "pid": pid,
+                        "username": owner(pid),
+                        "name": process.findtext("process_name"),
+                        "used_memory": process.findtext("used_memory"),
+                    }
+                    current_gpu_data["processes"].append(process_info)
+        current_gpu_data["memory"] = memory
+        gpu_data.append(current_gpu_data)
+        gpu.clear()
+    return gpu_data
+
+
+class ProcessOwnerCache:
+    """
+    Remembers the owner of every process that uses a GPU. A process is identified by its pid and its start time, so
+    that a process that got the pid of an already finished process is not mistaken for the old one.
+    """
+
+    def __init__(self, proc_root='/proc'):
+        self.proc_root = proc_root
+        self.owners = {}
+
+    def start_time(self, pid):
+        with open(os.path.join(self.proc_root, str(pid), 'stat')) as f:
+            stat = f.read()
+        # the process name in the second field may contain spaces and parentheses, the start time is the 22nd field
+        return int(stat[stat.rindex(')') + 2:].split()[19])
+
+    def read_owner(self, pid):
         UID = 1
-        for line in open('/proc/{}/status'.format(pid)):
+        for line in open(os.path.join(self.proc_root, str(pid), 'status')):
             if line.startswith('Uid:'):
                 uid = int(line.split()[UID])
-                return pwd.getpwuid(uid).pw_name
+                try:
+                    return pwd.getpwuid(uid).pw_name
+                except KeyError:
+                    return str(uid)
+
+    def owner(self, pid):
+        try:
+            key = (pid, self.start_time(pid))
+            if key not in self.owners:
+                self.owners[key] = self.read_owner(pid)
+            return self.owners[key]
+        except (OSError, ValueError, IndexError):
+            # the process exited while we were looking at it or its stat line is malformed
+            return "Unknown"
+
+    def retain(self, pids):
+        """
+        Forgets all processes whose pid is not in the given pids.
+        """
+        self.owners = {key: owner for key, owner in self.owners.items() if key[0] in pids}
+
+
+process_owners = ProcessOwnerCache()
+
+
+def owner(pid):
+    return process_owners.owner(pid)
+
+
+def query_gpu_data():
+    return parse_nvidia_xml(subprocess.check_output(["nvidia-smi", "-x", "-q"]))
+
+
+def nvml_text(value):
+    # depending on the version of the bindings NVML returns bytes or str
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def nvml_memory(value):
+    # same format as used by nvidia-smi
+    if value is None:
+        return "N/A"
+    return "{} MiB".format(value // 1024 ** 2)
+
+
+def query_gpu_data_nvml():
+    gpu_data = []
+    for index in range(pynvml.nvmlDeviceGetCount()):
+        handle = pynvml.nvmlDeviceGetHandleByIndex(index)
+        memory_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        current_gpu_data = {
+            "name": nvml_text(pynvml.nvmlDeviceGetName(handle)),
+            "uuid": nvml_text(pynvml.nvmlDeviceGetUUID(handle)),
+            "memory": {
+                "total": nvml_memory(memory_info.total),
+                "used": nvml_memory(memory_info.used),
+                "free": nvml_memory(memory_info.free),
+            },
+        }
+
+        try:
+            processes = pynvml.nvmlDeviceGetComputeRunningProcesses(handle)
+        except pynvml.NVMLError_NotSupported:
+            current_gpu_data["in_use"] = "na"
+        else:
+            current_gpu_data["in_use"] = "yes" if len(processes) > 0 else "no"
+            current_gpu_data["processes"] = []
+            for process in processes:
+                pid = str(process.pid)
+                try:
+                    name = nvml_text(pynvml.nvmlSystemGetProcessName(process.pid))
+                except pynvml.NVMLError:
+                    # the process exited after the list of processes was queried
+                    name = "Unknown"
+                current_gpu_data["processes"].append({
+                    "pid": pid,
+                    "username": owner(pid),
+                    "name": name,
+                    "used_memory": nvml_memory(process.usedGpuMemory),
+                })
+        gpu_data.append(current_gpu_data)
+    return gpu_data
+
+
+class GPUDataSampler(threading.Thread):
+    """
+    Samples the GPU data of this machine every interval seconds in the background, so that requests can be answered
+    from memory. Uses NVML if the pynvml bindings are available and falls back to calling nvidia-smi otherwise.
+    """
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.sample_lock = threading.Lock()
+        self.gpu_data = None
+        self.sampled_at = None
+        self.generation = 0
+
+        self.query = query_gpu_data
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                self.query = query_gpu_data_nvml
+            except pynvml.NVMLError as e:
+                print("Could not initialize NVML, falling back to nvidia-smi: {}".format(e), file=sys.stderr)
+
+    def sample(self):
+        """
+        Takes a new sample. Only one sample is taken at a time: callers that have to wait for a sample that is
+        already being taken use that one instead of taking another one.
+        """
+        generation = self.generation
+        with self.sample_lock:
+            if self.generation != generation:
+                return
+
+            gpu_data = self.query()
+            process_owners.retain({process["pid"] for gpu in gpu_data for process in gpu.get("processes", [])})
+            with self.lock:
+                self.gpu_data = gpu_data
+                self.sampled_at = time.monotonic()
+                self.generation += 1
+
+    def snapshot(self, max_age=None):
+        """
+        Returns the latest GPU data and its age in seconds, or (None, None) if no sample has been taken yet.
+        If the latest sample is older than max_age seconds a new sample is taken first.
+        """
+        if max_age is not None:
+            with self.lock:
+                outdated = self.gpu_data is None or time.monotonic() - self.sampled_at > max_age
+            if outdated:
+                self.sample()
+
+        with self.lock:
+            if self.gpu_data is None:
+                return None, None
+            return self.gpu_data, time.monotonic() - self.sampled_at
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print("Could not sample GPU data: {}".format(e), file=sys.stderr)
+            time.sleep(self.interval)
+
+
+COMPACT_CONTENT_TYPE = "application/vnd.labshare.compact+json"
+
+
+def memory_in_bytes(memory):
+    # nvidia-smi reports memory like "1234 MiB"
+    units = {"B": 1, "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3}
+    try:
+        value, unit = memory.split()
+        return int(value) * units[unit]
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+
+def compact_gpu_data(gpu_data):
+    """
+    Converts GPU data to the compact format, that reports all memory values as number of bytes.
+    """
+    compact_data = []
+    for gpu in gpu_data:
+        compact_gpu = dict(gpu)
+        compact_gpu["memory"] = {key: memory_in_bytes(value) for key, value in gpu["memory"].items()}
+        if "processes" in gpu:
+            compact_gpu["processes"] = [
+                dict(process, used_memory=memory_in_bytes(process["used_memory"])) for process in gpu["processes"]
+            ]
+        compact_data.append(compact_gpu)
+    return compact_data
+
+
+class DeviceQueryHandler(BaseHTTPRequestHandler):
+    """
+    Answers with the GPU data of this machine as JSON. Clients that ask for the compact format (with the query parameter
+    format=compact or by accepting application/vnd.labshare.compact+json) get unindented JSON with all memory values
+    as number of bytes, all other clients get the original format. Clients that accept gzip get a compressed response.
+    """
+    # keep connections open, so that LabShare can reuse them for its next requests
+    protocol_version = "HTTP/1.1"
+
+    def wants_compact_format(self):
+        query = parse_qs(urlparse(self.path).query)
+        return query.get("format") == ["compact"] or COMPACT_CONTENT_TYPE in self.headers.get("Accept", "")
+
+    def accepts_gzip(self):
+        return "gzip" in [encoding.split(";")[0].strip() for encoding in self.headers.get("Accept-Encoding", "").split(",")]
 
     def do_GET(self):
         try:
@@ -61,24 +294,117 @@ class DeviceQueryHandler(BaseHTTPRequestHandler):
                 self.send_error(403)
                 return
 
-            raw_gpu_data = subprocess.check_output(["nvidia-smi", "-x", "-q"]).decode('utf-8')
-            gpu_data = self.parse_nvidia_xml(raw_gpu_data)
+            gpu_data, age = self.sampler.snapshot(max_age=self.max_age)
+            if gpu_data is None:
+                self.send_error(503)
+                return
+
+            if self.wants_compact_format():
+                content_type = COMPACT_CONTENT_TYPE
+                body = bytes(json.dumps(compact_gpu_data(gpu_data), separators=(',', ':')), 'utf-8')
+            else:
+                content_type = "application/json"
+                body = bytes(json.dumps(gpu_data, indent=4), 'utf-8')
+
+            compress = self.accepts_gzip()
+            etag = '"{}{}"'.format(hashlib.sha1(body).hexdigest(), "-gzip" if compress else "")
+            if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                # the client already has this data
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept, Accept-Encoding")
+                self.send_header("X-Snapshot-Age", "{:.3f}".format(age))
+                self.end_headers()
+                return
+
             self.send_response(200)
-            self.send_header("Content-type", "application/json")
+            self.send_header("Content-type", content_type)
+            if compress:
+                body = gzip.compress(body)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept, Accept-Encoding")
+            self.send_header("X-Snapshot-Age", "{:.3f}".format(age))
             self.end_headers()
-            self.wfile.write(bytes(json.dumps(gpu_data, indent=4), 'utf-8'))
+            self.wfile.write(body)
         except Exception as e:
             self.send_error(500)
 
 
+class DeviceQueryServer(ThreadingMixIn, HTTPServer):
+    # every connection is handled in its own thread, so that a slow client does not block others
+    daemon_threads = True
+
+
+class GPUDataPusher(threading.Thread):
+    """
+    Pushes the GPU data of this machine to the LabShare server whenever it changed, but at least every
+    heartbeat seconds, so that LabShare knows that this machine is still alive.
+    """
+
+    def __init__(self, sampler, url, token, interval, heartbeat):
+        super().__init__(daemon=True)
+        self.sampler = sampler
+        self.url = url
+        self.token = token
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.last_pushed_data = None
+        self.last_push = 0
+
+    def push(self, data):
+        request = urllib.request.Request(
+            self.url,
+            data=gzip.compress(data),
+            headers={
+                "Content-Type": COMPACT_CONTENT_TYPE,
+                "Content-Encoding": "gzip",
+                "Authorization": "Token {}".format(self.token),
+            },
+            method="POST",
+        )
+        urllib.request.urlopen(request, timeout=10).read()
+
+    def run(self):
+        while True:
+            try:
+                gpu_data, _ = self.sampler.snapshot(max_age=self.interval)
+                if gpu_data is not None:
+                    compact_data = compact_gpu_data(gpu_data)
+                    data = bytes(json.dumps(compact_data, sort_keys=True, separators=(',', ':')), 'utf-8')
+                    if data != self.last_pushed_data or time.monotonic() - self.last_push >= self.heartbeat:
+                        self.push(data)
+                        self.last_pushed_data = data
+                        self.last_push = time.monotonic()
+            except Exception as e:
+                print("Could not push GPU data: {}".format(e), file=sys.stderr)
+            time.sleep(self.interval)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Tool that provides information about GPUs in this machine')
     parser.add_argument("-ac", "--allowed-client-address", default='.*', required=False, help="Restricts possible clients to given ip address")
+    parser.add_argument("--sample-interval", type=float, default=2, help="Seconds between two samples of the GPU data, 0 to only sample on request")
+    parser.add_argument("--max-age", type=float, default=10, help="Take a new sample when answering a request if the latest sample is older than this many seconds")
+    parser.add_argument("--push-url", required=False, help="Push GPU data to this LabShare url (e.g. https://<labshare>/device/<device name>/push) instead of waiting to be polled")
+    parser.add_argument("--push-token", required=False, help="Push token of this device as configured in LabShare")
+    parser.add_argument("--push-interval", type=float, default=1, help="Seconds between two checks for changed GPU data in push mode")
+    parser.add_argument("--heartbeat", type=float, default=60, help="Push GPU data at least every this many seconds in push mode")
 
     args = parser.parse_args()
+    if args.push_url is not None and args.push_token is None:
+        parser.error("--push-url requires --push-token")
+
+    sampler = GPUDataSampler(args.sample_interval)
+    if args.sample_interval > 0:
+        sampler.start()
+
+    if args.push_url is not None:
+        GPUDataPusher(sampler, args.push_url, args.push_token, args.push_interval, args.heartbeat).start()
 
-    RestrictedDeviceQueryHandler = type('RestrictedDeviceQueryHandler', (DeviceQueryHandler,), dict(allowed_client=args.allowed_client_address))
-    server = HTTPServer(("0.0.0.0", 12000), RestrictedDeviceQueryHandler)
+    RestrictedDeviceQueryHandler = type('RestrictedDeviceQueryHandler', (DeviceQueryHandler,), dict(allowed_client=args.allowed_client_address, sampler=sampler, max_age=args.max_age))
+    server = DeviceQueryServer(("0.0.0.0", 12000), RestrictedDeviceQueryHandler)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class LabshareConfig(AppConfig):
+    name = 'labshare'
+
+    def ready(self):
+        from labshare import signals  # noqa: F401
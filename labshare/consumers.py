@@ -1,33 +1,81 @@
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+import json
+from urllib.parse import parse_qs
 
-from labshare.models import Device
-from labshare.utils import publish_device_state
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 
+from labshare.utils import get_usable_devices, get_device_states, device_state_version
 
-class GPUInfoUpdater(WebsocketConsumer):
-    def connect(self):
+
+class GPUInfoUpdater(AsyncWebsocketConsumer):
+    async def connect(self):
         self.user = self.scope['user']
         self.device_name = self.scope['url_route']['kwargs']['device_name']
 
-        device = Device.objects.get(name=self.device_name)
-        if device.can_be_used_by(self.user):
-            async_to_sync(self.channel_layer.group_add)(
+        devices = await database_sync_to_async(get_usable_devices)(self.user, [self.device_name])
+        if devices:
+            # the state is read after joining the group, so that no update published in between is missed
+            await self.channel_layer.group_add(
                 self.device_name,
                 self.channel_name,
             )
+            device_states = await database_sync_to_async(get_device_states)(devices)
 
-            publish_device_state(device, self.channel_name)
-
-            self.accept()
+            await self.accept()
+            await self.send(text_data=device_states[0][1])
         else:
-            self.close()
+            await self.close()
 
-    def disconnect(self, message, **kwargs):
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, message, **kwargs):
+        await self.channel_layer.group_discard(
             self.device_name,
             self.channel_name,
         )
 
-    def update_info(self, event):
-        self.send(text_data=event['message'])
+    async def update_info(self, event):
+        await self.send(text_data=event['message'])
+
+
+class DevicesInfoUpdater(AsyncWebsocketConsumer):
+    """
+    Sends the state of all devices the user may use over a single connection. Every message contains the name of the
+    device it belongs to.
+    """
+
+    def known_versions(self):
+        # versions of the device states the client already has, e.g. because they were embedded into the page
+        query = parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+        try:
+            versions = json.loads(query['versions'][0])
+        except (KeyError, ValueError):
+            return {}
+        return versions if isinstance(versions, dict) else {}
+
+    async def connect(self):
+        self.user = self.scope['user']
+        devices = await database_sync_to_async(get_usable_devices)(self.user)
+        self.device_names = [device.name for device in devices]
+
+        # the states are read after joining the groups, so that no update published in between is missed
+        for device_name in self.device_names:
+            await self.channel_layer.group_add(
+                device_name,
+                self.channel_name,
+            )
+        device_states = await database_sync_to_async(get_device_states)(devices)
+
+        await self.accept()
+        known_versions = self.known_versions()
+        for device_name, device_state in device_states:
+            if known_versions.get(device_name) != device_state_version(device_state):
+                await self.send(text_data=device_state)
+
+    async def disconnect(self, message, **kwargs):
+        for device_name in getattr(self, 'device_names', []):
+            await self.channel_layer.group_discard(
+                device_name,
+                self.channel_name,
+            )
+
+    async def update_info(self, event):
+        await self.send(text_data=event['message'])
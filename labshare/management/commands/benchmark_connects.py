@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from labshare.consumers import DevicesInfoUpdater
+from labshare.models import Device
+
+# the benchmark publishes device states, which must neither replace the states cached by the running instance nor
+# reach its clients
+BENCHMARK_SETTINGS = {
+    "CACHES": {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "labshare-benchmark",
+        }
+    },
+    "CHANNEL_LAYERS": {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        }
+    },
+}
+
+
+class BenchmarkChannelLayer:
+
+    async def group_add(self, group, channel):
+        pass
+
+    async def group_discard(self, group, channel):
+        pass
+
+
+class BenchmarkConsumer(DevicesInfoUpdater):
+    # only counts what would be sent to the browser
+    bytes_sent = 0
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        BenchmarkConsumer.bytes_sent += len(text_data)
+
+
+class Command(BaseCommand):
+    help = "simulates many concurrent WebSocket connects to the overview page and reports how long they take with " \
+           "and without a cached device state"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username", help="user that connects")
+        parser.add_argument("--connections", type=int, default=100, help="number of concurrent connects")
+
+    async def connect_all(self, user, number_of_connections):
+        consumers = [BenchmarkConsumer({"user": user}) for _ in range(number_of_connections)]
+        for number, consumer in enumerate(consumers):
+            consumer.channel_layer = BenchmarkChannelLayer()
+            consumer.channel_name = "benchmark.{}".format(number)
+        await asyncio.gather(*(consumer.connect() for consumer in consumers))
+
+    def serialize_per_connect(self, user, number_of_connections):
+        # what every connect did before the serialized state was cached
+        for _ in range(number_of_connections):
+            for device in Device.objects.usable_by(user):
+                BenchmarkConsumer.bytes_sent += len(json.dumps(device.serialize()))
+
+    def measure(self, label, function, *args):
+        BenchmarkConsumer.bytes_sent = 0
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        self.stdout.write("{:<22} {:8.3f}s {:8.2f}ms per connect {:10d} bytes sent".format(
+            label, elapsed, elapsed / args[-1] * 1000, BenchmarkConsumer.bytes_sent
+        ))
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+        except User.DoesNotExist:
+            raise CommandError("user {} does not exist".format(options["username"]))
+        number_of_connections = options["connections"]
+
+        with override_settings(**BENCHMARK_SETTINGS):
+            self.measure("serialize per connect", self.serialize_per_connect, user, number_of_connections)
+            # the benchmark cache starts empty, so the state of all devices is published once like after a restart
+            self.measure("cold cache", async_to_sync(self.connect_all), user, number_of_connections)
+            self.measure("warm cache", async_to_sync(self.connect_all), user, number_of_connections)
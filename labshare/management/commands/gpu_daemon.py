@@ -0,0 +1,119 @@
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from channels.layers import channel_layers, DEFAULT_CHANNEL_LAYER
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connections
+
+from labshare.scheduler import ReservationScheduler
+from labshare.utils import update_gpu_info, determine_failed_gpus, publish_gpu_states, check_reservations
+
+
+# seconds to wait for the reservation scheduler to stop, e.g. another GPU daemon may have received its stop message
+LISTENER_STOP_TIMEOUT = 5
+
+
+def close_unusable_connections():
+    # connections are kept open between runs, but a connection that broke (e.g. database restart) has to be replaced
+    for connection in connections.all():
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+
+
+class Command(BaseCommand):
+    help = "keeps running and periodically updates GPU info, detects failed GPUs, publishes GPU states and " \
+           "checks reservations, each stage in its own interval. Reservations are also checked as soon as they " \
+           "expire or their users have to be reminded"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.scheduler = ReservationScheduler()
+
+    def add_arguments(self, parser):
+        for stage, interval in settings.GPU_DAEMON_INTERVALS.items():
+            parser.add_argument(
+                "--{}-interval".format(stage.replace("_", "-")),
+                dest="{}_interval".format(stage),
+                type=float,
+                default=interval,
+                help="seconds between two runs of the {} stage (default: {})".format(stage, interval),
+            )
+
+    def stop(self, signum=None, frame=None):
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def check_all_reservations(self):
+        check_reservations()
+        # catches up on changes the scheduler was not notified about
+        self.scheduler.rebuild()
+
+    def seconds_until_next_run(self, next_runs):
+        seconds = min(next_runs.values()) - time.monotonic()
+        scheduled_seconds = self.scheduler.seconds_until_next()
+        if scheduled_seconds is not None:
+            seconds = min(seconds, scheduled_seconds)
+        return max(0, seconds)
+
+    def run_stage(self, name, function):
+        close_unusable_connections()
+        try:
+            function()
+        except Exception as e:
+            print("{} stage failed: {}".format(name, e), file=sys.stderr)
+
+    def handle(self, *args, **options):
+        previous_handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+        executor = ThreadPoolExecutor(max_workers=settings.GPU_UPDATE_CONCURRENCY)
+        stages = [
+            ("update", partial(update_gpu_info, executor=executor)),
+            ("failed_gpus", determine_failed_gpus),
+            ("publish", publish_gpu_states),
+            ("reservations", self.check_all_reservations),
+        ]
+        next_runs = {name: time.monotonic() for name, _ in stages}
+
+        # the listener gets a channel layer of its own, the one of this thread is used to publish GPU states
+        listener_channel_layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+        listener = threading.Thread(
+            target=self.scheduler.listen,
+            args=(listener_channel_layer, self.stop_event, self.wake_event),
+            name="reservation scheduler",
+            daemon=True,
+        )
+        listener.start()
+
+        self.stdout.write("GPU daemon started")
+        while not self.stop_event.is_set():
+            for name, function in stages:
+                if self.stop_event.is_set():
+                    break
+                if next_runs[name] <= time.monotonic():
+                    self.run_stage(name, function)
+                    next_runs[name] = time.monotonic() + options["{}_interval".format(name)]
+
+            due_reservations = self.scheduler.pop_due()
+            if due_reservations and not self.stop_event.is_set():
+                self.run_stage("scheduled reservations", partial(check_reservations, reservation_ids=due_reservations))
+
+            self.wake_event.wait(self.seconds_until_next_run(next_runs))
+            self.wake_event.clear()
+
+        executor.shutdown(wait=False)
+        try:
+            self.scheduler.stop_listening(listener_channel_layer)
+        except Exception as e:
+            # the listener notices stop_event as soon as it fails to receive as well
+            print("Could not stop the reservation scheduler: {}".format(e), file=sys.stderr)
+        listener.join(LISTENER_STOP_TIMEOUT)
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        self.stdout.write("GPU daemon stopped")
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labshare', '0020_auto_20190805_1544'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='push_token',
+            field=models.CharField(blank=True, help_text='If set, the device_query agent of this device pushes its GPU info using this token and the device is not polled anymore.', max_length=255),
+        ),
+    ]
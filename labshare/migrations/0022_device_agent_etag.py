@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labshare', '0021_device_push_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='agent_etag',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labshare', '0022_device_agent_etag'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['usage_expires', 'extension_reminder_sent'], name='labshare_re_usage_e_241f0e_idx'),
+        ),
+    ]
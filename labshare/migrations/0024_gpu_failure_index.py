@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labshare', '0023_reservation_expiry_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gpu',
+            index=models.Index(fields=['marked_as_failed', 'last_updated'], name='labshare_gp_marked__a84d72_idx'),
+        ),
+    ]
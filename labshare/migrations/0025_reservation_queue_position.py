@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+def number_queues(apps, schema_editor):
+    Reservation = apps.get_model('labshare', 'Reservation')
+    queue_positions = {}
+    for reservation in Reservation.objects.order_by('gpu_id', 'time_reserved', 'pk'):
+        reservation.queue_position = queue_positions.get(reservation.gpu_id, 0)
+        queue_positions[reservation.gpu_id] = reservation.queue_position + 1
+        reservation.save(update_fields=['queue_position'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('labshare', '0024_gpu_failure_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reservation',
+            name='queue_position',
+            field=models.PositiveIntegerField(blank=True, default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(number_queues, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['gpu', 'queue_position'], name='labshare_re_gpu_id_952e42_idx'),
+        ),
+    ]
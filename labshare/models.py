@@ -1,17 +1,104 @@
 import pytz
+import uuid
 
 from datetime import timedelta
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import F, Max, Prefetch
 from django.utils import timezone
+from guardian.conf import settings as guardian_settings
+from guardian.shortcuts import get_objects_for_user
+
+
+USABLE_DEVICES_GENERATION_KEY = "labshare:usable_devices_generation"
+
+
+def is_prefetched(instance, related_name):
+    return related_name in getattr(instance, "_prefetched_objects_cache", {})
+
+
+def usable_devices_key(user, generation):
+    # guardian checks the permissions of anonymous users with its anonymous user
+    anonymous = user.is_anonymous or user.get_username() == guardian_settings.ANONYMOUS_USER_NAME
+    return "labshare:usable_devices:{}:{}".format(generation, "anonymous" if anonymous else user.pk)
+
+
+def usable_device_ids(user):
+    """
+    Returns the ids of all devices the given user can use. The ids are cached until device permissions, group
+    memberships or devices change (see labshare.signals).
+    """
+    if not user.is_anonymous and not user.is_active:
+        return set()
+
+    generation = cache.get_or_set(USABLE_DEVICES_GENERATION_KEY, uuid.uuid4().hex, None)
+    key = usable_devices_key(user, generation)
+    device_ids = cache.get(key)
+    if device_ids is None:
+        device_ids = set(
+            get_objects_for_user(user, "labshare.use_device", klass=Device, accept_global_perms=True)
+            .values_list("pk", flat=True)
+        )
+        cache.set(key, device_ids, settings.USABLE_DEVICES_CACHE_TIMEOUT)
+    return device_ids
+
+
+def invalidate_usable_devices(user=None):
+    """
+    Invalidates the cached usable devices of the given user or, if no user is given, of all users.
+    """
+    if user is None:
+        # a new generation makes all keys of the old one unreachable
+        cache.set(USABLE_DEVICES_GENERATION_KEY, uuid.uuid4().hex, None)
+        return
+    generation = cache.get(USABLE_DEVICES_GENERATION_KEY)
+    if generation is not None:
+        cache.delete(usable_devices_key(user, generation))
+
+
+class DeviceQuerySet(models.QuerySet):
+
+    def with_gpu_state(self):
+        """
+        Prefetches everything that is needed to serialize the devices, so that serializing any number of devices
+        takes a fixed number of queries.
+        """
+        return self.prefetch_related(Prefetch("gpus", queryset=GPU.objects.with_state()))
+
+    def usable_by(self, user):
+        """
+        Returns the devices that can be used by the given user (see Device.can_be_used_by) with a fixed number of
+        queries, regardless of the number of devices.
+        """
+        return self.filter(pk__in=usable_device_ids(user))
+
+
+class GPUQuerySet(models.QuerySet):
+
+    def with_reservations(self):
+        reservations = Reservation.objects.select_related("user").in_queue_order()
+        return self.prefetch_related(Prefetch("reservations", queryset=reservations))
+
+    def with_state(self):
+        return self.with_reservations().prefetch_related("processes")
 
 
 class Device(models.Model):
     name = models.CharField(max_length=255)
     ip_address = models.GenericIPAddressField()
+    push_token = models.CharField(
+        max_length=255,
+        blank=True,
+        help_text="If set, the device_query agent of this device pushes its GPU info using this token "
+                  "and the device is not polled anymore.",
+    )
+    # ETag of the GPU info that was last received from the device_query agent of this device
+    agent_etag = models.CharField(max_length=255, blank=True, editable=False)
+
+    objects = DeviceQuerySet.as_manager()
 
     class Meta:
         permissions = (
@@ -22,14 +109,13 @@ class Device(models.Model):
         return self.name
 
     def can_be_used_by(self, user):
-        content_type = ContentType.objects.get_for_model(self)
-        permission_name = "{app}.use_{model}".format(app=content_type.app_label, model=content_type.model)
-        return user.has_perm(permission_name, self) or user.has_perm(permission_name)
+        return self.pk in usable_device_ids(user)
 
     def serialize(self):
+        gpus = self.gpus.all() if is_prefetched(self, "gpus") else self.gpus.with_state()
         return {
             'name': self.name,
-            'gpus': [gpu.serialize() for gpu in self.gpus.all()]
+            'gpus': [gpu.serialize() for gpu in gpus]
         }
 
 
@@ -43,6 +129,14 @@ class GPU(models.Model):
     in_use = models.BooleanField(default=False)
     marked_as_failed = models.BooleanField(default=False)
 
+    objects = GPUQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # used by determine_failed_gpus to find GPUs that have not been updated in a while
+            models.Index(fields=["marked_as_failed", "last_updated"]),
+        ]
+
     def __str__(self):
         return self.model_name
 
@@ -50,27 +144,22 @@ class GPU(models.Model):
         return self.last_updated < timezone.now() - timedelta(minutes=30)
 
     def current_reservation(self):
-        try:
-            return self.reservations.earliest("time_reserved")
-        except Reservation.DoesNotExist as e:
-            return None
+        return self.reservations.in_queue_order().first()
 
     def last_reservation(self):
-        try:
-            return self.reservations.latest("time_reserved")
-        except Reservation.DoesNotExist as e:
-            return None
+        return self.reservations.in_queue_order().last()
+
+    def ordered_reservations(self):
+        if is_prefetched(self, "reservations"):
+            return list(self.reservations.all())
+        return list(self.reservations.select_related("user").in_queue_order())
 
     def get_next_reservations(self):
-        reservations = self.reservations.all()
-        if self.reservations.count() <= 1:
-            return []
-        return reservations.order_by("time_reserved").all()[1:]
+        return self.ordered_reservations()[1:]
 
     def get_current_reservation(self):
-        if self.reservations.count() == 0:
-            return None
-        return self.current_reservation()
+        reservations = self.ordered_reservations()
+        return reservations[0] if reservations else None
 
     def get_current_user(self):
         return getattr(self.get_current_reservation(), 'user', None)
@@ -82,9 +171,8 @@ class GPU(models.Model):
         return "{used} / {total}".format(used=self.used_memory, total=self.total_memory)
 
     def serialize(self):
-        extension_possible = False
-        if self.get_current_reservation() is not None:
-            extension_possible = self.get_current_reservation().is_extension_possible()
+        reservations = self.ordered_reservations()
+        current_reservation = reservations[0] if reservations else None
         return {
             'name': self.model_name,
             'uuid': self.uuid,
@@ -93,9 +181,9 @@ class GPU(models.Model):
             'last_update': self.last_updated.astimezone(pytz.timezone(settings.TIME_ZONE)).isoformat(),
             'failed': self.marked_as_failed,
             'in_use': self.in_use,
-            'current_user': getattr(self.get_current_user(), 'username', ''),
-            'extension_possible': extension_possible,
-            'next_users': [getattr(user, 'username', '') for user in self.get_next_users()]
+            'current_user': current_reservation.user.username if current_reservation is not None else '',
+            'extension_possible': current_reservation is not None and current_reservation.is_extension_possible(),
+            'next_users': [reservation.user.username for reservation in reservations[1:]]
         }
 
 
@@ -123,6 +211,12 @@ class GPUProcess(models.Model):
         }
 
 
+class ReservationQuerySet(models.QuerySet):
+
+    def in_queue_order(self):
+        return self.order_by("queue_position", "pk")
+
+
 class Reservation(models.Model):
     gpu = models.ForeignKey(GPU, related_name="reservations", on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name="reservations", on_delete=models.CASCADE)
@@ -131,10 +225,41 @@ class Reservation(models.Model):
     usage_expires = models.DateTimeField(null=True, blank=True)
     extension_reminder_sent = models.BooleanField(default=False)
     user_reserved_next_available_spot = models.BooleanField(default=False)
+    # position of the reservation in the queue of its GPU, the reservation at position 0 is the current one
+    queue_position = models.PositiveIntegerField(blank=True, editable=False)
+
+    objects = ReservationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # used by check_reservations to find expired and expiring reservations
+            models.Index(fields=["usage_expires", "extension_reminder_sent"]),
+            # the queue of a GPU is read in this order
+            models.Index(fields=["gpu", "queue_position"]),
+        ]
 
     def __str__(self):
         return "{gpu} on {device}, {user}".format(device=self.gpu.device, gpu=self.gpu, user=self.user)
 
+    def save(self, *args, **kwargs):
+        if self.queue_position is None:
+            # new reservations are queued behind all reservations of the GPU
+            last_position = self.gpu.reservations.aggregate(last_position=Max("queue_position"))["last_position"]
+            self.queue_position = 0 if last_position is None else last_position + 1
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            # the position may have changed since this reservation was loaded
+            queue_position = Reservation.objects.filter(pk=self.pk).values_list("queue_position", flat=True).first()
+            result = super().delete(*args, **kwargs)
+            if queue_position is not None:
+                # the reservations behind this one move up, so that the positions stay consecutive
+                Reservation.objects.filter(gpu_id=self.gpu_id, queue_position__gt=queue_position).update(
+                    queue_position=F("queue_position") - 1
+                )
+        return result
+
     @staticmethod
     def usage_period():
         return timedelta(days=8)
@@ -0,0 +1,151 @@
+"""
+All changes to the reservation queues of the GPUs. Every change runs in its own transaction that starts by locking the
+GPUs of the device, so that concurrent changes (e.g. two users reserving the same free GPU) are applied one after the
+other and each of them sees the result of the previous one. The functions return the queue of the GPU after the
+change, current reservation first.
+"""
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from labshare.models import GPU, Reservation
+
+
+def lock_gpus(device_pk):
+    """
+    Locks the GPUs of the given device until the end of the current transaction and returns them. The GPUs are always
+    locked in the same order, so that two transactions can not deadlock.
+    """
+    gpus = GPU.objects.filter(device_id=device_pk).order_by("pk")
+    if not connections[router.db_for_write(GPU)].features.has_select_for_update:
+        # SQLite ignores SELECT ... FOR UPDATE, but any write locks the database until the end of the transaction
+        gpus.update(in_use=F("in_use"))
+    return list(gpus.select_for_update())
+
+
+def lock_gpu(gpu):
+    for locked_gpu in lock_gpus(gpu.device_id):
+        if locked_gpu.pk == gpu.pk:
+            return locked_gpu
+    raise GPU.DoesNotExist
+
+
+def get_queue(gpu):
+    return list(gpu.reservations.select_related("user").in_queue_order())
+
+
+def end_current_reservation(gpu, reservation):
+    reservation.delete()
+
+    next_reservation = gpu.current_reservation()
+    if next_reservation is not None and next_reservation.usage_started is None:
+        next_reservation.start_usage()
+        # the user only wanted the next available GPU on this device and got it, the other reservations are obsolete
+        if next_reservation.user_reserved_next_available_spot:
+            obsolete_reservations = Reservation.objects.filter(
+                gpu__device_id=gpu.device_id,
+                user_id=next_reservation.user_id,
+                user_reserved_next_available_spot=True,
+            ).exclude(pk=next_reservation.pk)
+            for obsolete_reservation in obsolete_reservations:
+                obsolete_reservation.delete()
+    return get_queue(gpu)
+
+
+@transaction.atomic
+def reserve_gpu(gpu, user):
+    """
+    Queues a reservation of the given GPU for the given user, the usage starts right away if the GPU is free. Returns
+    the new reservation and the queue.
+    """
+    gpu = lock_gpu(gpu)
+    reservation = Reservation(gpu=gpu, user=user)
+    if not gpu.reservations.exists():
+        reservation.start_usage(save=False)
+    reservation.save()
+    return reservation, get_queue(gpu)
+
+
+@transaction.atomic
+def reserve_next_available_gpu(device, user):
+    """
+    Reserves a free GPU of the given device for the given user and starts its usage. If no GPU is free, all GPUs of the
+    device are reserved and the reservations that are not needed anymore are deleted as soon as one of them becomes
+    current. Returns the new reservations.
+    """
+    gpus = lock_gpus(device.pk)
+    reserved_gpus = set(Reservation.objects.filter(gpu__device_id=device.pk).values_list("gpu_id", flat=True))
+    for gpu in gpus:
+        if gpu.pk not in reserved_gpus:
+            reservation = Reservation(gpu=gpu, user=user)
+            reservation.start_usage(save=False)
+            reservation.save()
+            return [reservation]
+
+    reservations = []
+    for gpu in gpus:
+        reservation = Reservation(gpu=gpu, user=user, user_reserved_next_available_spot=True)
+        reservation.save()
+        reservations.append(reservation)
+    return reservations
+
+
+@transaction.atomic
+def finish_reservation(gpu, user):
+    """
+    Ends the current reservation of the given GPU, which has to belong to the given user, and starts the usage of the
+    next reservation.
+    """
+    gpu = lock_gpu(gpu)
+    reservation = gpu.current_reservation()
+    if reservation is None:
+        raise Reservation.DoesNotExist
+    if reservation.user_id != user.pk:
+        raise PermissionDenied
+    return end_current_reservation(gpu, reservation)
+
+
+@transaction.atomic
+def cancel_reservation(gpu, user):
+    """
+    Deletes the last reservation of the given user in the queue of the given GPU. The current reservation can not be
+    cancelled.
+    """
+    gpu = lock_gpu(gpu)
+    queue = get_queue(gpu)
+    user_reservations = [reservation for reservation in queue if reservation.user_id == user.pk]
+    if not user_reservations:
+        raise Reservation.DoesNotExist
+    if user_reservations[-1] == queue[0]:
+        raise SuspiciousOperation
+    user_reservations[-1].delete()
+    return get_queue(gpu)
+
+
+@transaction.atomic
+def extend_reservation(gpu, user):
+    """
+    Extends the current reservation of the given GPU, which has to belong to the given user.
+    """
+    gpu = lock_gpu(gpu)
+    reservation = gpu.current_reservation()
+    if reservation is None:
+        raise Reservation.DoesNotExist
+    if reservation.user_id != user.pk:
+        raise PermissionDenied
+    if not reservation.extend():
+        raise SuspiciousOperation
+    return get_queue(gpu)
+
+
+@transaction.atomic
+def end_expired_reservation(reservation):
+    """
+    Ends the given reservation if its usage period is over and starts the usage of the next reservation. Returns None
+    if the reservation was extended or ended in the meantime.
+    """
+    gpu = lock_gpu(reservation.gpu)
+    if not gpu.reservations.filter(pk=reservation.pk, usage_expires__lt=timezone.now()).exists():
+        return None
+    return end_current_reservation(gpu, reservation)
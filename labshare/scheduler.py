@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import sys
+import threading
+import uuid
+
+import channels.layers
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from labshare.models import Reservation
+
+
+RESERVATION_SCHEDULER_CHANNEL = "labshare.reservation-scheduler"
+STOP_LISTENING_TYPE = "reservation_scheduler.stop"
+
+
+def notify_reservation_scheduler(reservation):
+    """
+    Tells the reservation scheduler of the GPU daemon when the given reservation expires, so that it can expire the
+    reservation and remind its user in time.
+    """
+    channel_layer = channels.layers.get_channel_layer()
+    message = {
+        'type': 'reservation.changed',
+        'reservation': reservation.pk,
+        'usage_expires': reservation.usage_expires.isoformat(),
+        'extension_reminder_sent': reservation.extension_reminder_sent,
+    }
+    try:
+        async_to_sync(channel_layer.send)(RESERVATION_SCHEDULER_CHANNEL, message)
+    except ChannelFull:
+        # nobody is listening, the reservations are still checked when the GPU daemon (re)starts
+        print("Could not notify the reservation scheduler, the channel is full", file=sys.stderr)
+
+
+class ReservationScheduler:
+    """
+    Keeps a heap of the points in time at which reservations need an action: the end of their usage period and the
+    moment their users have to be reminded. The heap is built from the database once and then kept up to date with the
+    changes that are sent by notify_reservation_scheduler, so that the GPU daemon can wake up exactly when the next
+    reservation has to be checked.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        # the expiry each reservation is scheduled with, entries with a different expiry are outdated
+        self.expiries = {}
+        # changes that arrive while the heap is rebuilt, None if no rebuild is running
+        self.changes_during_rebuild = None
+        # identifies the stop messages meant for the listener of this scheduler
+        self.listener_id = uuid.uuid4().hex
+        self.listener_loop = None
+        self.listening = threading.Event()
+
+    def rebuild(self):
+        with self.lock:
+            self.changes_during_rebuild = []
+        try:
+            reservations = list(Reservation.objects.filter(usage_expires__isnull=False).values_list(
+                "pk", "usage_expires", "extension_reminder_sent"
+            ))
+        except Exception:
+            with self.lock:
+                self.changes_during_rebuild = None
+            raise
+
+        with self.lock:
+            changes, self.changes_during_rebuild = self.changes_during_rebuild, None
+            self.heap = []
+            self.expiries = {}
+            # the query may not have seen the changes that arrived while it ran
+            for change in reservations + changes:
+                self._add(*change)
+
+    def _add(self, reservation_pk, usage_expires, extension_reminder_sent):
+        if self.changes_during_rebuild is not None:
+            self.changes_during_rebuild.append((reservation_pk, usage_expires, extension_reminder_sent))
+
+        scheduled_expiry = self.expiries.get(reservation_pk)
+        if scheduled_expiry is not None and usage_expires <= scheduled_expiry:
+            # a usage period is only ever extended, so this change is outdated or already known
+            return
+        self.expiries[reservation_pk] = usage_expires
+        heapq.heappush(self.heap, (usage_expires, reservation_pk, usage_expires))
+        if not extension_reminder_sent:
+            heapq.heappush(self.heap, (usage_expires - Reservation.reminder_period(), reservation_pk, usage_expires))
+
+    def add(self, reservation_pk, usage_expires, extension_reminder_sent=False):
+        with self.lock:
+            self._add(reservation_pk, usage_expires, extension_reminder_sent)
+
+    def handle_message(self, message):
+        self.add(
+            message['reservation'],
+            parse_datetime(message['usage_expires']),
+            message['extension_reminder_sent'],
+        )
+
+    def seconds_until_next(self):
+        """
+        Returns the number of seconds until the next reservation has to be checked or None if there is none.
+        """
+        with self.lock:
+            if not self.heap:
+                return None
+            return max(0, (self.heap[0][0] - timezone.now()).total_seconds())
+
+    def pop_due(self):
+        """
+        Removes all entries that are due and returns the ids of the reservations they belong to.
+        """
+        now = timezone.now()
+        due = set()
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                when, reservation_pk, usage_expires = heapq.heappop(self.heap)
+                if self.expiries.get(reservation_pk) != usage_expires:
+                    # the reservation was extended after this entry was added
+                    continue
+                if when == usage_expires:
+                    del self.expiries[reservation_pk]
+                due.add(reservation_pk)
+        return due
+
+    def listen(self, channel_layer, stop_event, wake_event, retry_interval=1):
+        """
+        Receives the changes sent by notify_reservation_scheduler until stop_listening is called. wake_event is set
+        after every change. The connections of channel_layer belong to the event loop of the listener, so it must not
+        be shared with other threads.
+        """
+        async def receive():
+            self.listener_loop = asyncio.get_event_loop()
+            self.listening.set()
+            while True:
+                # a cancelled receive does not release the channel in channels_redis, so it is never cancelled and the
+                # listener is stopped with a message instead
+                try:
+                    message = await channel_layer.receive(RESERVATION_SCHEDULER_CHANNEL)
+                except Exception as e:
+                    if stop_event.is_set():
+                        # the stop message can not be received either
+                        return
+                    print("Could not receive reservation changes: {}".format(e), file=sys.stderr)
+                    await asyncio.sleep(retry_interval)
+                    continue
+                if message['type'] == STOP_LISTENING_TYPE:
+                    if message['listener'] == self.listener_id:
+                        return
+                    # meant for the listener of another GPU daemon, which stops after a timeout instead
+                    continue
+                self.handle_message(message)
+                wake_event.set()
+
+        try:
+            async_to_sync(receive)()
+        finally:
+            self.listening.clear()
+
+    def stop_listening(self, channel_layer, timeout=5):
+        """
+        Sends the stop message to the listener that receives with channel_layer. It is sent on the event loop of the
+        listener, which owns the connections of the channel layer.
+        """
+        if not self.listening.wait(timeout):
+            return
+        message = {'type': STOP_LISTENING_TYPE, 'listener': self.listener_id}
+        asyncio.run_coroutine_threadsafe(
+            channel_layer.send(RESERVATION_SCHEDULER_CHANNEL, message), self.listener_loop
+        ).result(timeout)
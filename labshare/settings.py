@@ -1,5 +1,6 @@
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import sys
 
 import ldap
 from django_auth_ldap.config import LDAPSearch, GroupOfNamesType
@@ -44,6 +45,18 @@ CHANNEL_LAYERS = {
     },
 }
 
+# The published device states and the devices each user may use are cached. The web server, the GPU daemon and
+# `manage.py update` run in different processes, so the cache has to be shared between them.
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    },
+}
+# the tests clear the cache, so they use their own redis database like they use their own database (see DATABASES)
+if sys.argv[1:2] == ['test']:
+    CACHES['default']['LOCATION'] = 'redis://127.0.0.1:6379/2'
+
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -71,6 +84,35 @@ EMAIL_BACKEND = 'labshare.backends.mail.open_smtp.OpenSMTPBackend'
 EMAIL_HOST = "localhost"
 EMAIL_PORT = "25"
 
+# Polling of the device_query agents: number of agents queried in parallel, timeout (in seconds) for a single agent
+# and the maximum time (in seconds) a whole update cycle may wait for answers.
+GPU_UPDATE_CONCURRENCY = 16
+GPU_UPDATE_HOST_TIMEOUT = 10
+GPU_UPDATE_DEADLINE = 20
+
+# Intervals (in seconds) in which the stages of `manage.py gpu_daemon` are run
+GPU_DAEMON_INTERVALS = {
+    "update": 5,
+    "failed_gpus": 60,
+    "publish": 5,
+    # reservations are checked as soon as they need an action, this only catches changes the daemon missed
+    "reservations": 300,
+}
+
+# If True, `publish_gpu_states` only sends the changed fields of the GPUs whose state changed since the last publish
+GPU_PUBLISH_DELTAS = True
+
+# Changes to the same device within this many seconds (e.g. by reservations) are published together
+GPU_PUBLISH_DELAY = 0.2
+
+# Seconds for which the last published state of a device is kept. New WebSocket connections are served this state,
+# an expired state is published again by the next connection
+PUBLISHED_DEVICE_STATE_TIMEOUT = 600
+
+# Seconds for which the devices a user may use are cached. The cache is invalidated when permissions, group
+# memberships or devices change, the timeout only covers changes that bypass signals (e.g. QuerySet.update)
+USABLE_DEVICES_CACHE_TIMEOUT = 300
+
 HIJACK_USE_BOOTSTRAP = True
 
 INSTALLED_APPS = (
@@ -0,0 +1,60 @@
+from django.contrib.auth.models import User, Group
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from guardian.models import UserObjectPermission, GroupObjectPermission
+
+from labshare.models import Device, Reservation, invalidate_usable_devices
+from labshare.scheduler import notify_reservation_scheduler
+
+
+@receiver(post_delete, sender=Device)
+@receiver([post_save, post_delete], sender=GroupObjectPermission)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_all_usable_devices(sender, action=None, **kwargs):
+    if action is None or action.startswith("post_"):
+        invalidate_usable_devices()
+
+
+@receiver(post_save, sender=Device)
+def invalidate_usable_devices_of_new_device(sender, created, **kwargs):
+    # users with a global permission may use new devices, changing a device (e.g. the agent ETag that is saved on
+    # every update) does not change who may use it
+    if created:
+        invalidate_usable_devices()
+
+
+@receiver([post_save, post_delete], sender=UserObjectPermission)
+def invalidate_usable_devices_of_permission_user(sender, instance, **kwargs):
+    invalidate_usable_devices(instance.user)
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_usable_devices_of_user(sender, instance, update_fields=None, **kwargs):
+    # logging in only updates last_login, which does not change any permission
+    if update_fields is not None and set(update_fields) == {"last_login"}:
+        return
+    invalidate_usable_devices(instance)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_usable_devices_of_members(sender, instance, action, reverse, pk_set, **kwargs):
+    # group memberships are also changed by the LDAP backend when a user logs in
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        invalidate_usable_devices(instance)
+    elif pk_set is not None:
+        for user in User.objects.filter(pk__in=pk_set):
+            invalidate_usable_devices(user)
+    else:
+        invalidate_usable_devices()
+
+
+@receiver(post_save, sender=Reservation)
+def schedule_reservation(sender, instance, update_fields=None, **kwargs):
+    # Reservation.start_usage and Reservation.extend change the expiry
+    if instance.usage_expires is None or (update_fields is not None and "usage_expires" not in update_fields):
+        return
+    transaction.on_commit(lambda: notify_reservation_scheduler(instance))
@@ -1,25 +1,42 @@
+import asyncio
 import datetime
+import gzip
+import importlib.util
 import io
 import json
 import os
 import random
+import signal
 import string
+import threading
+import tempfile
 import time
+import unittest
 import unittest.mock as mock
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from unittest import skipIf
 from unittest.mock import Mock
 from urllib.error import URLError
+from urllib.parse import urlencode
 
-from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer, InMemoryChannelLayer
 from channels.testing import ChannelsLiveServerTestCase
 from django import template
-from django.contrib.auth.models import User, Group
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User, Group, Permission
 from django.core import mail
-from django.test import TestCase, override_settings, Client
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django_webtest import WebTest
-from guardian.shortcuts import assign_perm
+from guardian.shortcuts import assign_perm, remove_perm
 from guardian.utils import get_anonymous_user
 from model_mommy import mommy
 from model_mommy.recipe import Recipe
@@ -29,11 +46,15 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 
-from labshare.consumers import GPUInfoUpdater
-from labshare.models import Device, GPU, Reservation, GPUProcess, EmailAddress
+from labshare.consumers import GPUInfoUpdater, DevicesInfoUpdater
+from labshare.models import Device, GPU, Reservation, GPUProcess, EmailAddress, usable_device_ids
+from labshare.reservation_queue import reserve_gpu, reserve_next_available_gpu, finish_reservation, \
+    cancel_reservation, end_expired_reservation
+from labshare.scheduler import ReservationScheduler, RESERVATION_SCHEDULER_CHANNEL, STOP_LISTENING_TYPE
 from labshare.templatetags.icon import icon
-from labshare.utils import get_devices, update_gpu_info, determine_failed_gpus, publish_gpu_states, \
-    publish_device_state, check_reservations
+from labshare.utils import AgentConnectionPool, DevicePublisher, get_devices, update_gpu_info, apply_gpu_info, determine_failed_gpus, publish_gpu_states, \
+    publish_device_state, check_reservations, published_device_state_key, AGENT_COMPACT_CONTENT_TYPE, \
+    get_device_states, get_usable_devices, device_state_version
 
 device_recipe = Recipe(
     Device,
@@ -81,6 +102,18 @@ class TestLabshare(LabshareTestSetup):
         for device in self.devices:
             self.assertIn(device.name, response.body.decode('utf-8'))
 
+    def test_index_initial_state(self):
+        cache.clear()
+        response = self.app.get(reverse("index"), user=self.user)
+        initial_state = json.loads(response.html.find(id="initial-state").string)
+
+        self.assertEqual(initial_state["devices"], [device.serialize() for device in self.devices])
+        for device in self.devices:
+            self.assertEqual(
+                initial_state["versions"][device.name],
+                device_state_version(cache.get(published_device_state_key(device)))
+            )
+
     def test_reserve_no_user(self):
         response = self.app.get(reverse("reserve"), expect_errors=True)
         self.assertEqual(response.status_code, 302)
@@ -238,6 +271,60 @@ class TestLabshare(LabshareTestSetup):
         )
         self.assertEqual(response.status_code, 404)
 
+    def get_gpu_status(self, *device_names, **kwargs):
+        query = "&".join("device_name={}".format(device_name) for device_name in device_names)
+        return self.app.get("{url}?{query}".format(url=reverse("gpu_status"), query=query), **kwargs)
+
+    def test_gpu_status(self):
+        reservations = [mommy.make(Reservation, gpu=self.gpu, user=mommy.make(User)) for _ in range(3)]
+        response = self.get_gpu_status(self.devices[1].name, user=self.user, xhr=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.body.decode('utf-8')), {
+            "devices": [{
+                "name": self.devices[1].name,
+                "gpus": [{
+                    "id": self.gpu.uuid,
+                    "name": self.gpu.model_name,
+                    "used": "12 Mib",
+                    "total": "112 Mib",
+                    "user": reservations[0].user.username,
+                    "queue_length": 2,
+                }],
+            }],
+        })
+
+    def test_gpu_status_multiple_devices(self):
+        response = self.get_gpu_status(*[device.name for device in self.devices[:2]], user=self.user, xhr=True)
+        data = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(sorted(device["name"] for device in data["devices"]), sorted(d.name for d in self.devices[:2]))
+
+        response = self.get_gpu_status(user=self.user, xhr=True)
+        data = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(len(data["devices"]), len(self.devices))
+        for device in data["devices"]:
+            for gpu in device["gpus"]:
+                self.assertEqual((gpu["user"], gpu["queue_length"]), ("No current user", 0))
+
+    def test_gpu_status_query_count(self):
+        for gpu in GPU.objects.all():
+            mommy.make(Reservation, gpu=gpu, user=mommy.make(User), _quantity=2)
+        self.get_gpu_status(user=self.user, xhr=True)
+
+        with CaptureQueriesContext(connection) as context:
+            self.get_gpu_status(self.devices[0].name, user=self.user, xhr=True)
+        for device in self.devices:
+            mommy.make(GPU, device=device, _quantity=4)
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.get_gpu_status(self.devices[0].name, user=self.user, xhr=True)
+
+    def test_gpu_status_bad_requests(self):
+        response = self.get_gpu_status(self.devices[0].name, expect_errors=True, xhr=True)
+        self.assertEqual(response.status_code, 401)
+        response = self.get_gpu_status(self.devices[0].name, user=self.user, expect_errors=True)
+        self.assertEqual(response.status_code, 400)
+        response = self.get_gpu_status("unknown", self.devices[0].name, user=self.user, expect_errors=True, xhr=True)
+        self.assertEqual(response.status_code, 404)
+
     def test_get_gpu_info_bad_requests(self):
         response = self.app.get(
             "{url}?uuid={uuid}".format(url=reverse("gpu_info"), uuid=self.devices[0].gpus.first().uuid),
@@ -444,6 +531,39 @@ class TestLabshare(LabshareTestSetup):
         self.assertEqual(Reservation.objects.count(), 1)
         self.assertEqual(gpu.current_reservation().user, other)
 
+    def test_reservations_queue_positions(self):
+        gpu = self.devices[0].gpus.first()
+        other_gpu = self.devices[0].gpus.last()
+        reservations = mommy.make(Reservation, gpu=gpu, user=self.user, _quantity=4)
+        other_reservation = mommy.make(Reservation, gpu=other_gpu, user=self.user)
+        self.assertEqual([reservation.queue_position for reservation in reservations], [0, 1, 2, 3])
+        self.assertEqual(other_reservation.queue_position, 0)
+
+        # the positions of reservations that were loaded before are outdated after the first delete
+        reservations[1].delete()
+        reservations[2].delete()
+        self.assertEqual(list(gpu.reservations.in_queue_order().values_list("pk", "queue_position")), [
+            (reservations[0].pk, 0),
+            (reservations[3].pk, 1),
+        ])
+        self.assertEqual(Reservation.objects.get(pk=other_reservation.pk).queue_position, 0)
+
+        reservations[0].delete()
+        self.assertEqual(gpu.current_reservation(), reservations[3])
+        self.assertEqual(gpu.current_reservation().queue_position, 0)
+        self.assertEqual(mommy.make(Reservation, gpu=gpu, user=self.user).queue_position, 1)
+
+    def test_queue_order_independent_of_reservation_time(self):
+        gpu = self.devices[0].gpus.first()
+        other = mommy.make(User)
+        first_reservation = mommy.make(Reservation, gpu=gpu, user=self.user)
+        mommy.make(Reservation, gpu=gpu, user=other)
+        Reservation.objects.filter(pk=first_reservation.pk).update(time_reserved=utc_now() + timedelta(hours=1))
+
+        self.assertEqual(gpu.current_reservation().user, self.user)
+        self.assertEqual(gpu.last_reservation().user, other)
+        self.assertEqual(gpu.get_next_users(), [other])
+
     def test_gpu_updated_too_long_ago(self):
         for gpu in GPU.objects.all():
             last_updated = gpu.last_updated
@@ -634,6 +754,40 @@ class TestReservationExpiration(LabshareTestSetup):
         self.assertFalse(reservation.extension_reminder_sent)
 
 
+    def test_reservation_checking_query_count(self):
+        make_reservation_in_the_past(self.user, self.gpu, timedelta(days=2))
+        with CaptureQueriesContext(connection) as context:
+            check_reservations()
+
+        for device in self.devices:
+            for gpu in device.gpus.all():
+                make_reservation_in_the_past(self.other_user, gpu, timedelta(days=1))
+                mommy.make(Reservation, gpu=gpu, user=self.user)
+        with self.assertNumQueries(len(context.captured_queries)):
+            check_reservations()
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_reservation_checking_only_given_reservations(self):
+        reservation = make_reservation_in_the_past(self.user, self.gpu, Reservation.usage_period())
+        other_reservation = make_reservation_in_the_past(self.other_user, self.devices[0].gpus.first(),
+                                                         Reservation.usage_period())
+        check_reservations(reservation_ids=[other_reservation.pk])
+
+        self.assertEqual(list(Reservation.objects.all()), [reservation])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to[0], "otheruser@example.com")
+
+    def test_reservation_checking_reminding_many(self):
+        for device in self.devices:
+            for gpu in device.gpus.all():
+                make_reservation_in_the_past(self.user, gpu, Reservation.usage_period() - Reservation.reminder_period())
+        check_reservations()
+
+        self.assertEqual(len(mail.outbox), GPU.objects.count())
+        self.assertFalse(Reservation.objects.filter(extension_reminder_sent=False).exists())
+        check_reservations()
+        self.assertEqual(len(mail.outbox), GPU.objects.count())
+
 class TestMessages(WebTest):
 
     csrf_checks = False
@@ -951,6 +1105,18 @@ class LabSharePermissionTests(WebTest):
         response = self.app.get(reverse('gpu_info') + '?uuid={}'.format(self.devices[-1].gpus.first().uuid), user=self.staff_user, xhr=True)
         self.assertEqual(response.status_code, 200)
 
+    def test_gpu_status(self):
+        url = "{}?device_name={}".format(reverse('gpu_status'), self.devices[-1].name)
+        response = self.app.get(url, user=self.user, expect_errors=True, xhr=True)
+        self.assertEqual(response.status_code, 403)
+
+        response = self.app.get(url, user=self.staff_user, xhr=True)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get(reverse('gpu_status'), user=self.user, xhr=True)
+        device_names = [device["name"] for device in json.loads(response.body.decode('utf-8'))["devices"]]
+        self.assertEqual(sorted(device_names), sorted(device.name for device in self.devices[:-1]))
+
     def test_gpu_info_non_existent_gpu(self):
         ids_to_test = ['undefined', 'a_name_that_will_never_exist_at_least_we_hope_so']
         for id in ids_to_test:
@@ -1077,11 +1243,21 @@ def working_gpu_data_with_one_gpu_use_na_true(url, timeout=None):
     return json.dumps([base_data])
 
 
-def return_bytes_io(func):
-    def wrapper(*args, **kwargs):
-        data = func(*args, **kwargs)
-        stream = io.BytesIO(bytearray(data, encoding='utf-8'))
-        return stream
+class AgentResponse:
+
+    def __init__(self, status=200, headers=None):
+        self.status = status
+        self.reason = "OK"
+        self.headers = headers or {}
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+def agent_response(func):
+    def wrapper(address, timeout=None, headers=None):
+        data = func(address, timeout=timeout)
+        return AgentResponse(), bytes(data, encoding='utf-8')
     return wrapper
 
 
@@ -1090,7 +1266,7 @@ class UpdateGPUTests(TestCase):
     def setUp(self):
         self.device = device_recipe.make()
 
-    @mock.patch("urllib.request.urlopen", fail_url)
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(fail_url))
     def test_update_gpu_info_no_gpu_works(self):
         mommy.make(Device)
         for device in Device.objects.all():
@@ -1101,13 +1277,13 @@ class UpdateGPUTests(TestCase):
         for timestamp_before_call, timestamp_after_call in zip(pre_call_last_update, post_call_last_update):
             self.assertEqual(timestamp_before_call, timestamp_after_call)
 
-    @mock.patch("urllib.request.urlopen", return_bytes_io(working_gpu_data_with_one_gpu_not_in_use))
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_not_in_use))
     def test_update_gpu_info_new_gpu(self):
         self.assertEqual(GPU.objects.count(), 0)
         update_gpu_info()
         self.assertEqual(GPU.objects.count(), 1)
 
-    @mock.patch("urllib.request.urlopen", return_bytes_io(working_gpu_data_with_one_gpu_in_use))
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_in_use))
     def test_update_gpu_info_new_gpu_in_use(self):
         self.assertEqual(GPU.objects.count(), 0)
         update_gpu_info()
@@ -1116,7 +1292,7 @@ class UpdateGPUTests(TestCase):
         self.assertTrue(gpu.in_use)
         self.assertEqual(GPUProcess.objects.count(), 1)
 
-    @mock.patch("urllib.request.urlopen", return_bytes_io(working_gpu_data_with_one_gpu_use_na_false))
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_use_na_false))
     def test_update_gpu_info_new_gpu_use_na_false(self):
         self.assertEqual(GPU.objects.count(), 0)
         update_gpu_info()
@@ -1124,7 +1300,7 @@ class UpdateGPUTests(TestCase):
         gpu = GPU.objects.get()
         self.assertFalse(gpu.in_use)
 
-    @mock.patch("urllib.request.urlopen", return_bytes_io(working_gpu_data_with_one_gpu_use_na_true))
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_use_na_true))
     def test_update_gpu_info_new_gpu_use_na_true(self):
         self.assertEqual(GPU.objects.count(), 0)
         update_gpu_info()
@@ -1132,7 +1308,7 @@ class UpdateGPUTests(TestCase):
         gpu = GPU.objects.get()
         self.assertTrue(gpu.in_use)
 
-    @mock.patch("urllib.request.urlopen", return_bytes_io(working_gpu_data_with_one_gpu_in_use))
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_in_use))
     def test_update_gpu_info_old_gpu_switch_to_in_use(self):
         mommy.make(GPU, device=self.device, uuid="lorem", in_use=False)
         self.assertEqual(GPU.objects.count(), 1)
@@ -1143,7 +1319,7 @@ class UpdateGPUTests(TestCase):
         self.assertTrue(gpu.in_use)
         self.assertEqual(GPUProcess.objects.count(), 1)
 
-    @mock.patch("urllib.request.urlopen", return_bytes_io(working_gpu_data_with_one_gpu_in_use))
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_in_use))
     def test_update_gpu_info_old_gpu_add_new_in_use_gpu(self):
         mommy.make(GPU, device=self.device, uuid="test", in_use=False)
         self.assertEqual(GPU.objects.count(), 1)
@@ -1154,7 +1330,7 @@ class UpdateGPUTests(TestCase):
         self.assertTrue(gpu.in_use)
         self.assertEqual(GPUProcess.objects.count(), 1)
 
-    @mock.patch("urllib.request.urlopen", return_bytes_io(working_gpu_data_with_one_gpu_in_use))
+    @mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_in_use))
     def test_update_gpu_info_old_gpu_add_new_processes(self):
         gpu = mommy.make(GPU, device=self.device, uuid="lorem", in_use=False)
         process = mommy.make(GPUProcess, gpu=gpu)
@@ -1168,6 +1344,424 @@ class UpdateGPUTests(TestCase):
         self.assertNotEqual(GPUProcess.objects.get(), process)
 
 
+    def test_update_gpu_info_one_failing_device_does_not_stop_others(self):
+        failing_device = device_recipe.make(ip_address="10.0.0.1")
+
+        def request(address, timeout=None, headers=None):
+            if address == failing_device.ip_address:
+                return fail_url(address, timeout=timeout)
+            return agent_response(working_gpu_data_with_one_gpu_not_in_use)(address, timeout=timeout)
+
+        with mock.patch("labshare.utils.agent_connections.request", request):
+            update_gpu_info()
+        self.assertEqual(GPU.objects.filter(device=self.device).count(), 1)
+        self.assertEqual(GPU.objects.filter(device=failing_device).count(), 0)
+
+    @override_settings(GPU_UPDATE_DEADLINE=0.5)
+    def test_update_gpu_info_slow_device_does_not_stall_update(self):
+        slow_device = device_recipe.make(ip_address="10.0.0.2")
+        Device.objects.filter(id=self.device.id).update(ip_address="10.0.0.3")
+
+        def request(address, timeout=None, headers=None):
+            if address == slow_device.ip_address:
+                time.sleep(2)
+            return agent_response(working_gpu_data_with_one_gpu_not_in_use)(address, timeout=timeout)
+
+        start = time.monotonic()
+        with mock.patch("labshare.utils.agent_connections.request", request):
+            update_gpu_info()
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(GPU.objects.filter(device=self.device).count(), 1)
+        self.assertEqual(GPU.objects.filter(device=slow_device).count(), 0)
+
+    @override_settings(GPU_UPDATE_CONCURRENCY=4)
+    def test_update_gpu_info_queries_devices_concurrently(self):
+        for device in device_recipe.make(_quantity=3):
+            device.ip_address = "10.0.1.{}".format(device.id)
+            device.save()
+
+        def request(address, timeout=None, headers=None):
+            time.sleep(0.5)
+            data = json.loads(working_gpu_data_with_one_gpu_not_in_use(address, timeout=timeout))
+            data[0]["uuid"] = address
+            return AgentResponse(), bytes(json.dumps(data), encoding='utf-8')
+
+        start = time.monotonic()
+        with mock.patch("labshare.utils.agent_connections.request", request):
+            update_gpu_info()
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(GPU.objects.count(), 4)
+
+
+    def test_update_gpu_info_keeps_unchanged_processes(self):
+        gpu = mommy.make(GPU, device=self.device, uuid="lorem", in_use=True, used_memory="20 MB", total_memory="100 MB")
+        process = mommy.make(GPUProcess, gpu=gpu, pid=1, username="Mr. Keks", name="TestProcess", memory_usage="10 MB")
+        with mock.patch("labshare.utils.agent_connections.request", agent_response(working_gpu_data_with_one_gpu_in_use)):
+            update_gpu_info()
+        self.assertEqual(GPUProcess.objects.get(), process)
+
+    def test_update_gpu_info_query_count_independent_of_gpu_count(self):
+        def gpu_data(num_gpus, used_memory):
+            return [{
+                "name": "Test GPU",
+                "uuid": "{}-{}".format(num_gpus, i),
+                "memory": {"total": "100 MB", "used": used_memory, "free": "80 MB"},
+                "in_use": "yes",
+                "processes": [{
+                    "pid": str(pid),
+                    "username": "Mr. Keks",
+                    "name": "TestProcess",
+                    "used_memory": used_memory,
+                } for pid in range(4)],
+            } for i in range(num_gpus)]
+
+        def count_queries(device, num_gpus, used_memory):
+            with CaptureQueriesContext(connection) as context:
+                apply_gpu_info(device, gpu_data(num_gpus, used_memory))
+            return len(context.captured_queries)
+
+        large_device = device_recipe.make()
+        # initial insert, then changed data and finally unchanged data
+        for used_memory in ["20 MB", "30 MB", "30 MB"]:
+            num_queries_small = count_queries(self.device, 1, used_memory)
+            num_queries_large = count_queries(large_device, 8, used_memory)
+            self.assertEqual(num_queries_small, num_queries_large)
+        self.assertEqual(GPUProcess.objects.count(), 9 * 4)
+        self.assertTrue(all(gpu.used_memory == "30 MB" for gpu in GPU.objects.all()))
+
+
+class ConditionalUpdateGPUTests(TestCase):
+
+    def setUp(self):
+        self.device = device_recipe.make()
+        self.requests = []
+
+    def agent(self, status, etag="\"v1\""):
+        def request(address, timeout=None, headers=None):
+            self.requests.append(headers)
+            if status == 304:
+                return AgentResponse(status=304, headers={"ETag": etag}), b""
+            data = working_gpu_data_with_one_gpu_in_use(address, timeout=timeout)
+            return AgentResponse(headers={"ETag": etag}), bytes(data, encoding='utf-8')
+        return mock.patch("labshare.utils.agent_connections.request", request)
+
+    def test_etag_stored_and_sent(self):
+        with self.agent(200):
+            update_gpu_info()
+        self.assertEqual(Device.objects.get().agent_etag, '"v1"')
+        self.assertNotIn("If-None-Match", self.requests[0])
+
+        with self.agent(304):
+            update_gpu_info()
+        self.assertEqual(self.requests[1]["If-None-Match"], '"v1"')
+
+    def test_unchanged_device_not_written(self):
+        with self.agent(200):
+            update_gpu_info()
+        last_updated = GPU.objects.get().last_updated
+
+        with self.agent(304), CaptureQueriesContext(connection) as context:
+            update_gpu_info()
+        self.assertEqual(GPU.objects.get().last_updated, last_updated)
+        self.assertEqual(GPUProcess.objects.count(), 1)
+        statements = [query["sql"].split()[0] for query in context.captured_queries]
+        self.assertNotIn("INSERT", statements)
+        self.assertNotIn("DELETE", statements)
+
+    def test_unchanged_device_keeps_gpus_alive(self):
+        with self.agent(200):
+            update_gpu_info()
+        with mock.patch("django.utils.timezone.now") as mock_now:
+            mock_now.return_value = utc_now() - datetime.timedelta(hours=2)
+            GPU.objects.update(last_updated=mock_now.return_value, marked_as_failed=True)
+
+        with self.agent(304):
+            update_gpu_info()
+        gpu = GPU.objects.get()
+        self.assertFalse(gpu.last_update_too_long_ago())
+        self.assertFalse(gpu.marked_as_failed)
+
+    def test_changed_device_updated(self):
+        with self.agent(200):
+            update_gpu_info()
+        with self.agent(200, etag='"v2"'):
+            update_gpu_info()
+        self.assertEqual(Device.objects.get().agent_etag, '"v2"')
+        self.assertEqual(self.requests[1]["If-None-Match"], '"v1"')
+
+
+def load_device_query():
+    # device_query is a standalone script that is deployed to the GPU machines, not a package
+    spec = importlib.util.spec_from_file_location(
+        "device_query", os.path.join(settings.BASE_DIR, "device_query", "device_query.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+device_query = load_device_query()
+
+
+class ProcessOwnerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.proc_root.cleanup)
+        self.owners = device_query.ProcessOwnerCache(proc_root=self.proc_root.name)
+
+    def fake_process(self, pid, start_time, uid, stat=None):
+        process_dir = os.path.join(self.proc_root.name, str(pid))
+        os.makedirs(process_dir, exist_ok=True)
+        with open(os.path.join(process_dir, "stat"), "w") as f:
+            fields = ["S"] + ["0"] * 18 + [str(start_time)] + ["0"] * 10
+            f.write(stat if stat is not None else "{} (python3 (train) x) {}\n".format(pid, " ".join(fields)))
+        with open(os.path.join(process_dir, "status"), "w") as f:
+            f.write("Name:\tpython3\nUid:\t{0}\t{0}\t{0}\t{0}\n".format(uid))
+
+    @mock.patch("pwd.getpwuid", side_effect=KeyError)
+    def test_owner_cached_until_pid_reused(self, getpwuid_mock):
+        self.fake_process("42", start_time=1000, uid=1001)
+        self.assertEqual(self.owners.owner("42"), "1001")
+
+        # a cached owner is not read again, even if the status file changed
+        self.fake_process("42", start_time=1000, uid=1002)
+        self.assertEqual(self.owners.owner("42"), "1001")
+
+        # a new process with the same pid has a different start time
+        self.fake_process("42", start_time=2000, uid=1002)
+        self.assertEqual(self.owners.owner("42"), "1002")
+
+        self.owners.retain({"7"})
+        self.assertEqual(self.owners.owners, {})
+
+    def test_owner_of_exited_process(self):
+        self.assertEqual(self.owners.owner("43"), "Unknown")
+
+    def test_owner_with_malformed_stat(self):
+        for stat in ["44 (python3) S 1 2", "44 python3 S", ""]:
+            self.fake_process("44", start_time=0, uid=0, stat=stat)
+            self.assertEqual(self.owners.owner("44"), "Unknown")
+
+
+class FakeNVMLError(Exception):
+    pass
+
+
+class NVMLSamplerTests(unittest.TestCase):
+
+    def test_process_exited_during_sample(self):
+        nvml = mock.Mock(
+            NVMLError=FakeNVMLError,
+            NVMLError_NotSupported=type("FakeNVMLErrorNotSupported", (FakeNVMLError,), {}),
+        )
+        nvml.nvmlDeviceGetCount.return_value = 1
+        nvml.nvmlDeviceGetName.return_value = b"GeForce GTX 1080"
+        nvml.nvmlDeviceGetUUID.return_value = b"GPU-1"
+        nvml.nvmlDeviceGetMemoryInfo.return_value = mock.Mock(total=8 * 1024 ** 3, used=1024 ** 3, free=7 * 1024 ** 3)
+        nvml.nvmlDeviceGetComputeRunningProcesses.return_value = [
+            mock.Mock(pid=1, usedGpuMemory=1024 ** 2), mock.Mock(pid=2, usedGpuMemory=1024 ** 2),
+        ]
+        nvml.nvmlSystemGetProcessName.side_effect = [b"python3", FakeNVMLError("Not Found")]
+
+        with mock.patch.object(device_query, "pynvml", nvml), mock.patch.object(device_query, "owner") as owner_mock:
+            owner_mock.return_value = "user"
+            gpu_data = device_query.query_gpu_data_nvml()
+
+        self.assertEqual([process["name"] for process in gpu_data[0]["processes"]], ["python3", "Unknown"])
+
+
+class AgentConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        self.connections = []
+        self.close_connections = False
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(handler):
+                super().setup()
+                self.connections.append(handler.client_address)
+
+            def do_GET(handler):
+                # simulates an agent that closes idle connections without announcing it
+                handler.close_connection = self.close_connections
+                body = working_gpu_data_with_one_gpu_not_in_use(None).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = type("Server", (ThreadingMixIn, HTTPServer), {"daemon_threads": True})(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pool = AgentConnectionPool(port=self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            response, body = self.pool.request("127.0.0.1", timeout=5)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(json.loads(body.decode('utf-8'))[0]["uuid"], "lorem")
+        self.assertEqual(len(self.connections), 1)
+
+    def test_reconnect_after_connection_closed_by_agent(self):
+        self.close_connections = True
+        self.pool.request("127.0.0.1", timeout=5)
+        self.close_connections = False
+        time.sleep(0.1)
+        response, _ = self.pool.request("127.0.0.1", timeout=5)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(self.connections), 2)
+
+
+def compact_gpu_data():
+    data = json.loads(working_gpu_data_with_one_gpu_in_use(None))
+    data[0]["memory"] = {"used": 900 * 1024 ** 2, "total": 8 * 1024 ** 3}
+    data[0]["processes"][0]["used_memory"] = 10 * 1024 ** 2
+    return json.dumps(data).encode('utf-8')
+
+
+class CompactGPUInfoTests(TestCase):
+
+    def setUp(self):
+        self.device = device_recipe.make()
+
+    def agent(self, body, response_headers):
+        def request(address, timeout=None, headers=None):
+            self.assertEqual(headers["Accept"], AGENT_COMPACT_CONTENT_TYPE)
+            self.assertEqual(headers["Accept-Encoding"], "gzip")
+            return AgentResponse(headers=response_headers), body
+        return mock.patch("labshare.utils.agent_connections.request", request)
+
+    def assert_gpu_stored(self):
+        gpu = GPU.objects.get()
+        self.assertEqual(gpu.used_memory, "900 MiB")
+        self.assertEqual(gpu.total_memory, "8192 MiB")
+        self.assertEqual(GPUProcess.objects.get().memory_usage, "10 MiB")
+
+    def test_compact_format(self):
+        with self.agent(compact_gpu_data(), {"Content-Type": AGENT_COMPACT_CONTENT_TYPE}):
+            update_gpu_info()
+        self.assert_gpu_stored()
+
+    def test_compact_format_gzip(self):
+        headers = {"Content-Type": AGENT_COMPACT_CONTENT_TYPE, "Content-Encoding": "gzip"}
+        with self.agent(gzip.compress(compact_gpu_data()), headers):
+            update_gpu_info()
+        self.assert_gpu_stored()
+
+    def test_original_format(self):
+        body = working_gpu_data_with_one_gpu_in_use(None).encode('utf-8')
+        with self.agent(body, {"Content-Type": "application/json"}):
+            update_gpu_info()
+        self.assertEqual(GPUProcess.objects.get().memory_usage, "10 MB")
+
+    def test_unknown_process_memory(self):
+        data = json.loads(compact_gpu_data().decode('utf-8'))
+        data[0]["processes"][0]["used_memory"] = None
+        with self.agent(json.dumps(data).encode('utf-8'), {"Content-Type": AGENT_COMPACT_CONTENT_TYPE}):
+            update_gpu_info()
+        self.assertEqual(GPUProcess.objects.get().memory_usage, "N/A")
+
+
+class PushGPUInfoTests(TestCase):
+
+    def setUp(self):
+        self.device = device_recipe.make(push_token="secret")
+        self.url = reverse("push_gpu_info", args=[self.device.name])
+        self.data = working_gpu_data_with_one_gpu_in_use(None)
+
+    def push(self, data, token="secret"):
+        headers = {} if token is None else {"HTTP_AUTHORIZATION": "Token {}".format(token)}
+        return self.client.post(self.url, data, content_type="application/json", **headers)
+
+    @mock.patch("labshare.views.schedule_device_publish")
+    def test_push_gpu_info(self, publish_mock):
+        response = self.push(self.data)
+        self.assertEqual(response.status_code, 200)
+        gpu = GPU.objects.get()
+        self.assertEqual(gpu.device, self.device)
+        self.assertTrue(gpu.in_use)
+        self.assertEqual(GPUProcess.objects.count(), 1)
+        publish_mock.assert_called_with(self.device)
+
+    @mock.patch("labshare.views.schedule_device_publish")
+    def test_push_gpu_info_unchanged_not_published(self, publish_mock):
+        self.push(self.data)
+        publish_mock.reset_mock()
+        response = self.push(self.data)
+        self.assertEqual(response.status_code, 200)
+        publish_mock.assert_not_called()
+
+    @mock.patch("labshare.views.schedule_device_publish")
+    def test_push_gpu_info_compact_gzip(self, publish_mock):
+        response = self.client.post(
+            self.url, gzip.compress(compact_gpu_data()), content_type=AGENT_COMPACT_CONTENT_TYPE,
+            HTTP_CONTENT_ENCODING="gzip", HTTP_AUTHORIZATION="Token secret"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(GPU.objects.get().used_memory, "900 MiB")
+
+    def test_push_gpu_info_wrong_method(self):
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Token secret")
+        self.assertEqual(response.status_code, 400)
+
+    def test_push_gpu_info_unknown_device(self):
+        response = self.client.post(
+            reverse("push_gpu_info", args=["unknown"]), self.data, content_type="application/json",
+            HTTP_AUTHORIZATION="Token secret"
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_push_gpu_info_not_authenticated(self):
+        # compare_digest only accepts ASCII strings
+        for token in [None, "wrong", "", "s\u00e9cret"]:
+            response = self.push(self.data, token=token)
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(GPU.objects.count(), 0)
+
+    def test_push_gpu_info_device_without_push_token(self):
+        self.device.push_token = ""
+        self.device.save()
+        response = self.push(self.data, token="")
+        self.assertEqual(response.status_code, 403)
+
+    def test_push_gpu_info_malformed_data(self):
+        for data in ["no json", json.dumps([{"name": "Test GPU"}])]:
+            response = self.push(data)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(GPU.objects.count(), 0)
+
+    def test_push_gpu_info_corrupt_gzip(self):
+        compressed = gzip.compress(self.data.encode("utf-8"))
+        # truncated stream and broken deflate data
+        for body in [compressed[:len(compressed) // 2], compressed[:10] + b"\xff" * 20 + compressed[-8:]]:
+            response = self.client.post(
+                self.url, body, content_type="application/json", HTTP_CONTENT_ENCODING="gzip",
+                HTTP_AUTHORIZATION="Token secret"
+            )
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(GPU.objects.count(), 0)
+
+    def test_push_gpu_info_gpu_of_other_device(self):
+        other_gpu = mommy.make(GPU, uuid=json.loads(self.data)[0]["uuid"])
+        response = self.push(self.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(GPU.objects.get(), other_gpu)
+
+    @mock.patch("labshare.utils.agent_connections.request")
+    def test_push_device_not_polled(self, request_mock):
+        update_gpu_info()
+        request_mock.assert_not_called()
+
+
 admin_mail = "test@example.com"
 
 
@@ -1196,10 +1790,12 @@ class FailedGPUTests(TestCase):
 
         pre_last_update = self.gpu_1.last_updated
         determine_failed_gpus()
-        self.assertEqual(len(mail.outbox), 1)
-        sent_mail = mail.outbox[0]
+        self.assertEqual(len(mail.outbox), 2)
+        sent_mail, admin_summary = mail.outbox
         self.assertIn(self.user.email, sent_mail.to)
-        self.assertIn(admin_mail, sent_mail.cc)
+        self.assertNotIn(admin_mail, sent_mail.to + sent_mail.cc)
+        self.assertEqual(admin_summary.to, [admin_mail])
+        self.assertIn(self.user.username, admin_summary.body)
         gpu = GPU.objects.get(id=self.gpu_1.id)
         self.assertTrue(gpu.marked_as_failed)
         self.assertEqual(gpu.last_updated, pre_last_update)
@@ -1213,11 +1809,11 @@ class FailedGPUTests(TestCase):
 
         pre_last_update = self.gpu_1.last_updated
         determine_failed_gpus()
-        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(mail.outbox), 2)
         sent_mail = mail.outbox[0]
         for address in all_email_addresses:
             self.assertIn(address, sent_mail.to)
-        self.assertIn(admin_mail, sent_mail.cc)
+        self.assertEqual(sent_mail.cc, [])
         gpu = GPU.objects.get(id=self.gpu_1.id)
         self.assertTrue(gpu.marked_as_failed)
         self.assertEqual(gpu.last_updated, pre_last_update)
@@ -1243,13 +1839,15 @@ class FailedGPUTests(TestCase):
 
         first_mail = mail.outbox[0]
         self.assertIn(self.user.email, first_mail.to)
-        self.assertIn(admin_mail, first_mail.cc)
+        self.assertEqual(first_mail.cc, [])
         gpu = GPU.objects.get(id=self.gpu_1.id)
         self.assertTrue(gpu.marked_as_failed)
 
         second_mail = mail.outbox[1]
-        self.assertIn(admin_mail, second_mail.to)
-        self.assertIn(admin_mail, second_mail.cc)
+        self.assertEqual(second_mail.to, [admin_mail])
+        self.assertEqual(second_mail.cc, [])
+        self.assertIn(self.gpu_1.model_name, second_mail.body)
+        self.assertIn(self.gpu_2.model_name, second_mail.body)
         gpu = GPU.objects.get(id=self.gpu_2.id)
         self.assertTrue(gpu.marked_as_failed)
 
@@ -1266,6 +1864,83 @@ class FailedGPUTests(TestCase):
         self.assertIn(self.gpu_2.model_name, mail.outbox[0].message().as_string())
 
 
+    def test_failed_device_one_mail_per_user(self):
+        device = device_recipe.make()
+        with mock.patch("django.utils.timezone.now") as mock_now:
+            mock_now.return_value = utc_now() - datetime.timedelta(hours=2)
+            gpus = mommy.make(GPU, device=device, _quantity=8)
+        for gpu in gpus:
+            mommy.make(Reservation, user=self.user, gpu=gpu)
+
+        determine_failed_gpus()
+        self.assertEqual(len(mail.outbox), 2)
+        user_mail, admin_mail_message = mail.outbox
+        self.assertIn(self.user.email, user_mail.to)
+        self.assertEqual(user_mail.body.count(device.name), 8)
+        self.assertEqual(admin_mail_message.to, [admin_mail])
+        self.assertEqual(admin_mail_message.body.count(device.name), 8)
+        self.assertIn(self.gpu_1.model_name, admin_mail_message.body)
+        self.assertEqual(GPU.objects.filter(marked_as_failed=True).count(), 9)
+
+    def test_failed_device_one_mail_to_admins(self):
+        device = device_recipe.make()
+        with mock.patch("django.utils.timezone.now") as mock_now:
+            mock_now.return_value = utc_now() - datetime.timedelta(hours=2)
+            gpus = mommy.make(GPU, device=device, _quantity=8)
+        users = mommy.make(User, _quantity=8)
+        for gpu, user in zip(gpus, users):
+            mommy.make(Reservation, user=user, gpu=gpu)
+
+        determine_failed_gpus()
+        self.assertEqual(len(mail.outbox), 9)
+        admin_mails = [message for message in mail.outbox if admin_mail in message.to + message.cc]
+        self.assertEqual(len(admin_mails), 1)
+        for user in users:
+            self.assertIn(user.username, admin_mails[0].body)
+
+    def test_failed_gpus_query_count(self):
+        mommy.make(Reservation, user=self.user, gpu=self.gpu_1)
+        with CaptureQueriesContext(connection) as context:
+            determine_failed_gpus()
+        GPU.objects.update(marked_as_failed=False)
+
+        with mock.patch("django.utils.timezone.now") as mock_now:
+            mock_now.return_value = utc_now() - datetime.timedelta(hours=2)
+            for gpu in mommy.make(GPU, _quantity=8):
+                mommy.make(Reservation, user=mommy.make(User), gpu=gpu)
+        with self.assertNumQueries(len(context.captured_queries)):
+            determine_failed_gpus()
+
+
+@override_settings(ADMINS=(("Test", admin_mail),))
+class ConcurrentFailedGPUTests(TransactionTestCase):
+
+    def test_gpu_updated_while_checking_not_marked(self):
+        with mock.patch("django.utils.timezone.now") as mock_now:
+            mock_now.return_value = utc_now() - datetime.timedelta(hours=2)
+            gpu = mommy.make(GPU)
+        updating = threading.Event()
+
+        def update_gpu():
+            try:
+                with transaction.atomic():
+                    gpu.save()
+                    updating.set()
+                    # the check starts while the update is not committed yet
+                    time.sleep(0.5)
+            finally:
+                updating.set()
+                connection.close()
+
+        thread = threading.Thread(target=update_gpu)
+        thread.start()
+        updating.wait()
+        determine_failed_gpus()
+        thread.join()
+
+        self.assertFalse(GPU.objects.get(pk=gpu.pk).marked_as_failed)
+        self.assertEqual(len(mail.outbox), 0)
+
 class HijackTests(WebTest):
     csrf_checks = False
 
@@ -1321,6 +1996,8 @@ def async_to_sync_mock(func_name):
 class PublishMethodTests(TestCase):
 
     def setUp(self):
+        cache.clear()
+        send_function_mock.reset_mock()
         self.device = device_recipe.make()
         self.device_2 = device_recipe.make()
         self.user = mommy.make(User)
@@ -1362,9 +2039,416 @@ class PublishMethodTests(TestCase):
         send_function_mock.assert_called_with(channel_name, data)
 
 
-class ConsumerTests(TestCase):
+@mock.patch('labshare.utils.async_to_sync', async_to_sync_mock)
+class PublishChangesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        send_function_mock.reset_mock()
+        self.device = device_recipe.make()
+        self.gpus = mommy.make(GPU, device=self.device, used_memory="100 MiB", _quantity=2)
+
+    def published_messages(self):
+        messages = [json.loads(call[0][1]['message']) for call in send_function_mock.call_args_list]
+        send_function_mock.reset_mock()
+        return messages
+
+    def test_unchanged_state_not_published(self):
+        publish_gpu_states()
+        self.assertEqual(self.published_messages(), [self.device.serialize()])
+        publish_gpu_states()
+        self.assertEqual(self.published_messages(), [])
+
+    def test_changed_gpu_published_as_delta(self):
+        publish_gpu_states()
+        self.published_messages()
+
+        GPU.objects.filter(pk=self.gpus[0].pk).update(used_memory="900 MiB")
+        publish_gpu_states()
+        gpu = GPU.objects.get(pk=self.gpus[0].pk)
+        self.assertEqual(self.published_messages(), [{
+            'name': self.device.name,
+            'delta': True,
+            'gpus': [{'uuid': gpu.uuid, 'memory': gpu.memory_usage()}],
+        }])
+
+    @override_settings(PUBLISHED_DEVICE_STATE_TIMEOUT=60)
+    def test_published_state_expires(self):
+        with mock.patch.object(cache, "set_many", wraps=cache.set_many) as set_many_mock:
+            publish_gpu_states()
+        set_many_mock.assert_called_once_with({published_device_state_key(self.device): mock.ANY}, 60)
+
+        with mock.patch.object(cache, "set", wraps=cache.set) as set_mock:
+            publish_device_state(self.device)
+        set_mock.assert_called_once_with(published_device_state_key(self.device), mock.ANY, 60)
+
+    def test_added_gpu_published_in_full(self):
+        publish_gpu_states()
+        self.published_messages()
+
+        mommy.make(GPU, device=self.device)
+        publish_gpu_states()
+        self.assertEqual(self.published_messages(), [self.device.serialize()])
+
+    @override_settings(GPU_PUBLISH_DELTAS=False)
+    def test_deltas_disabled(self):
+        publish_gpu_states()
+        self.published_messages()
+
+        mommy.make(GPUProcess, gpu=self.gpus[0])
+        publish_gpu_states()
+        self.assertEqual(self.published_messages(), [self.device.serialize()])
+
+    def test_publish_device_state_always_publishes(self):
+        publish_device_state(self.device)
+        publish_device_state(self.device)
+        self.assertEqual(self.published_messages(), [self.device.serialize()] * 2)
+
+        publish_gpu_states()
+        self.assertEqual(self.published_messages(), [])
+
+
+class DevicePublisherTests(TransactionTestCase):
+
+    def setUp(self):
+        self.device = device_recipe.make()
+        self.device_2 = device_recipe.make()
+        self.publisher = DevicePublisher()
+
+    def published_devices(self, publish_mock):
+        return sorted(call[0][0].pk for call in publish_mock.call_args_list)
+
+    @override_settings(GPU_PUBLISH_DELAY=60)
+    @mock.patch("labshare.utils.publish_device_state")
+    def test_publishes_coalesced(self, publish_mock):
+        for _ in range(3):
+            self.publisher.schedule(self.device)
+        self.publisher.schedule(self.device_2)
+        publish_mock.assert_not_called()
+
+        self.publisher.flush()
+        self.assertEqual(self.published_devices(publish_mock), [self.device.pk, self.device_2.pk])
+        self.assertIsNone(self.publisher.timer)
+
+    @override_settings(GPU_PUBLISH_DELAY=0.01)
+    @mock.patch("labshare.utils.publish_device_state")
+    def test_publishes_after_delay(self, publish_mock):
+        self.publisher.schedule(self.device)
+        self.publisher.schedule(self.device)
+        self.publisher.timer.join()
+        self.assertEqual(self.published_devices(publish_mock), [self.device.pk])
+
+    @override_settings(GPU_PUBLISH_DELAY=0)
+    @mock.patch("labshare.utils.publish_device_state")
+    def test_publishes_immediately_without_delay(self, publish_mock):
+        self.publisher.schedule(self.device)
+        self.assertEqual(self.published_devices(publish_mock), [self.device.pk])
+
+    @override_settings(GPU_PUBLISH_DELAY=60)
+    @mock.patch("labshare.utils.publish_device_state")
+    def test_publishes_after_commit(self, publish_mock):
+        with transaction.atomic():
+            self.publisher.schedule(self.device)
+            self.assertEqual(self.publisher.pending, set())
+        self.assertEqual(self.publisher.pending, {self.device.pk})
+        self.publisher.flush()
+
+    @override_settings(GPU_PUBLISH_DELAY=60)
+    @mock.patch("labshare.utils.device_publisher")
+    def test_expired_reservations_published_once(self, publisher_mock):
+        mommy.make(GPU, device=self.device, _quantity=3)
+        for gpu in self.device.gpus.all():
+            reservation = mommy.make(Reservation, gpu=gpu, user=mommy.make(User))
+            reservation.start_usage()
+            reservation.usage_expires = utc_now() - timedelta(hours=1)
+            reservation.save()
+
+        check_reservations()
+        self.assertEqual(publisher_mock.schedule.call_count, 3)
+        publisher_mock.flush.assert_called_once_with()
+
+
+@mock.patch("labshare.signals.notify_reservation_scheduler", mock.Mock())
+class ReservationQueueTests(TransactionTestCase):
+
+    def setUp(self):
+        self.device = device_recipe.make()
+        self.gpus = mommy.make(GPU, device=self.device, _quantity=3)
+
+    def run_concurrently(self, function, arguments):
+        barrier = threading.Barrier(len(arguments))
+        errors = []
+
+        def run(*args):
+            try:
+                barrier.wait()
+                function(*args)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=args) for args in arguments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def assertQueueConsistent(self, gpu):
+        queue = list(gpu.reservations.in_queue_order())
+        self.assertEqual([reservation.queue_position for reservation in queue], list(range(len(queue))))
+        self.assertEqual([reservation.usage_started is not None for reservation in queue],
+                         [True] + [False] * (len(queue) - 1))
+
+    def test_concurrent_reservations_of_free_gpu(self):
+        users = mommy.make(User, _quantity=16)
+        self.run_concurrently(reserve_gpu, [(self.gpus[0], user) for user in users])
+
+        self.assertEqual(self.gpus[0].reservations.count(), len(users))
+        self.assertQueueConsistent(self.gpus[0])
+
+    def test_concurrent_reservations_of_next_available_gpu(self):
+        users = mommy.make(User, _quantity=12)
+        self.run_concurrently(reserve_next_available_gpu, [(self.device, user) for user in users])
+
+        started_reservations = Reservation.objects.filter(usage_started__isnull=False)
+        self.assertEqual(sorted(reservation.gpu_id for reservation in started_reservations),
+                         [gpu.pk for gpu in self.gpus])
+        for gpu in self.gpus:
+            self.assertEqual(gpu.reservations.count(), 1 + len(users) - len(self.gpus))
+            self.assertQueueConsistent(gpu)
+
+    def test_concurrent_reservations_and_finishing(self):
+        users = mommy.make(User, _quantity=8)
+        for user in users[:4]:
+            reserve_gpu(self.gpus[0], user)
+
+        def reserve_or_finish(user):
+            if user in users[:4]:
+                # users can only finish their reservation once it is current
+                deadline = time.monotonic() + 10
+                while time.monotonic() < deadline:
+                    try:
+                        finish_reservation(self.gpus[0], user)
+                        return
+                    except PermissionDenied:
+                        time.sleep(0.001)
+                raise AssertionError("reservation of {} never became current".format(user))
+            reserve_gpu(self.gpus[0], user)
+
+        self.run_concurrently(reserve_or_finish, [(user,) for user in users])
+
+        self.assertEqual({reservation.user for reservation in self.gpus[0].reservations.all()}, set(users[4:]))
+        self.assertQueueConsistent(self.gpus[0])
+
+    def test_expired_reservation_extended_in_the_meantime(self):
+        user = mommy.make(User)
+        reservation = make_reservation_in_the_past(user, self.gpus[0], Reservation.usage_period())
+        Reservation.objects.filter(pk=reservation.pk).update(usage_expires=utc_now() + timedelta(hours=1))
+
+        self.assertIsNone(end_expired_reservation(reservation))
+        self.assertTrue(Reservation.objects.filter(pk=reservation.pk).exists())
+
+    def test_cancel_current_reservation(self):
+        user = mommy.make(User)
+        reserve_gpu(self.gpus[0], user)
+        with self.assertRaises(SuspiciousOperation):
+            cancel_reservation(self.gpus[0], user)
+        with self.assertRaises(Reservation.DoesNotExist):
+            cancel_reservation(self.gpus[0], mommy.make(User))
+        self.assertEqual(self.gpus[0].reservations.count(), 1)
+
+
+class UsableDevicesTests(TestCase):
+
+    def setUp(self):
+        self.devices = device_recipe.make(_quantity=4)
+        self.group = mommy.make(Group)
+        self.user = mommy.make(User)
+        self.user.groups.add(self.group)
+        assign_perm('labshare.use_device', self.user, self.devices[0])
+        assign_perm('labshare.use_device', self.group, self.devices[1])
+
+    def assert_usable_devices(self, user, expected_devices):
+        usable_devices = set(Device.objects.usable_by(user))
+        self.assertEqual(usable_devices, set(expected_devices))
+        self.assertEqual(usable_devices, {device for device in self.devices if device.can_be_used_by(user)})
+
+    def test_object_permissions(self):
+        self.assert_usable_devices(self.user, self.devices[:2])
+
+    def test_global_permission(self):
+        user = mommy.make(User)
+        assign_perm('labshare.use_device', user)
+        self.assert_usable_devices(user, self.devices)
+
+    def test_superuser(self):
+        self.assert_usable_devices(mommy.make(User, is_superuser=True), self.devices)
+
+    def test_anonymous_user(self):
+        self.assert_usable_devices(AnonymousUser(), [])
+        assign_perm('labshare.use_device', get_anonymous_user(), self.devices[2])
+        self.assert_usable_devices(AnonymousUser(), [self.devices[2]])
+
+    def test_query_count_independent_of_device_count(self):
+        with CaptureQueriesContext(connection) as context:
+            list(Device.objects.usable_by(User.objects.get(pk=self.user.pk)))
+
+        for device in device_recipe.make(_quantity=20):
+            assign_perm('labshare.use_device', self.group, device)
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.assertEqual(len(Device.objects.usable_by(User.objects.get(pk=self.user.pk))), 22)
+
+
+class UsableDevicesCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.devices = device_recipe.make(_quantity=2)
+        self.group = mommy.make(Group)
+        self.user = mommy.make(User)
+        assign_perm('labshare.use_device', self.group, self.devices[0])
+
+    def assert_usable_devices(self, expected_devices):
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(set(Device.objects.usable_by(user)), set(expected_devices))
+
+    def test_cached(self):
+        self.assertFalse(self.devices[0].can_be_used_by(self.user))
+        with self.assertNumQueries(0):
+            for device in self.devices:
+                self.assertFalse(device.can_be_used_by(self.user))
+
+    def test_object_permission_changed(self):
+        self.assert_usable_devices([])
+        assign_perm('labshare.use_device', self.user, self.devices[1])
+        self.assert_usable_devices([self.devices[1]])
+        remove_perm('labshare.use_device', self.user, self.devices[1])
+        self.assert_usable_devices([])
+
+    def test_group_permission_changed(self):
+        self.user.groups.add(self.group)
+        self.assert_usable_devices([self.devices[0]])
+        assign_perm('labshare.use_device', self.group, self.devices[1])
+        self.assert_usable_devices(self.devices)
+
+    def test_group_membership_changed(self):
+        self.assert_usable_devices([])
+        # the LDAP backend adds users through the group
+        self.group.user_set.add(self.user)
+        self.assert_usable_devices([self.devices[0]])
+        self.user.groups.clear()
+        self.assert_usable_devices([])
+        self.user.groups.add(self.group)
+        self.assert_usable_devices([self.devices[0]])
+        self.group.user_set.clear()
+        self.assert_usable_devices([])
+
+    def test_global_permission_and_new_device(self):
+        self.user.groups.add(self.group)
+        self.group.permissions.add(Permission.objects.get(codename="use_device"))
+        self.assert_usable_devices(self.devices)
+        device = device_recipe.make()
+        self.assert_usable_devices(self.devices + [device])
+
+    def test_superuser_and_inactive_user(self):
+        self.assert_usable_devices([])
+        self.user.is_superuser = True
+        self.user.save()
+        self.assert_usable_devices(self.devices)
+        self.user.is_active = False
+        self.user.save()
+        self.assert_usable_devices([])
+
+    def test_login_keeps_cache(self):
+        self.assertFalse(self.devices[0].can_be_used_by(self.user))
+        self.user.last_login = utc_now()
+        self.user.save(update_fields=["last_login"])
+        with self.assertNumQueries(0):
+            self.assertFalse(self.devices[0].can_be_used_by(self.user))
+
+
+    def test_changed_device_keeps_cache(self):
+        self.assertFalse(self.devices[0].can_be_used_by(self.user))
+        self.devices[0].agent_etag = '"etag"'
+        self.devices[0].save(update_fields=["agent_etag"])
+        self.devices[0].save()
+        with self.assertNumQueries(0):
+            self.assertFalse(self.devices[0].can_be_used_by(self.user))
+
+    def test_deleted_device(self):
+        self.user.groups.add(self.group)
+        self.assert_usable_devices([self.devices[0]])
+        self.devices[0].delete()
+        self.assertEqual(usable_device_ids(User.objects.get(pk=self.user.pk)), set())
+
+
+class SerializeQueryCountTests(TestCase):
+
+    def setUp(self):
+        self.devices = device_recipe.make(_quantity=2)
+
+    def add_gpus(self, device, number):
+        for gpu in mommy.make(GPU, device=device, _quantity=number):
+            mommy.make(GPUProcess, gpu=gpu, _quantity=2)
+            for _ in range(3):
+                mommy.make(Reservation, gpu=gpu, user=mommy.make(User))
+
+    def test_serialize_device(self):
+        self.add_gpus(self.devices[0], 8)
+        with self.assertNumQueries(3):
+            data = self.devices[0].serialize()
+        self.assertEqual(len(data["gpus"]), 8)
+        for gpu_data in data["gpus"]:
+            self.assertEqual(len(gpu_data["processes"]), 2)
+            self.assertNotEqual(gpu_data["current_user"], "")
+            self.assertEqual(len(gpu_data["next_users"]), 2)
+
+    def test_serialize_keeps_reservation_order(self):
+        gpu = mommy.make(GPU, device=self.devices[0])
+        users = mommy.make(User, _quantity=3)
+        for user in users:
+            mommy.make(Reservation, gpu=gpu, user=user)
+
+        for device in [self.devices[0], Device.objects.with_gpu_state().get(pk=self.devices[0].pk)]:
+            gpu_data = device.serialize()["gpus"][0]
+            self.assertEqual(gpu_data["current_user"], users[0].username)
+            self.assertEqual(gpu_data["next_users"], [user.username for user in users[1:]])
+
+    @mock.patch('labshare.utils.async_to_sync', async_to_sync_mock)
+    def test_publish_gpu_states_query_count(self):
+        for device in self.devices:
+            self.add_gpus(device, 4)
+        with self.assertNumQueries(4):
+            publish_gpu_states()
+
+        self.devices.extend(device_recipe.make(_quantity=3))
+        for device in self.devices[2:]:
+            self.add_gpus(device, 8)
+        with self.assertNumQueries(4):
+            publish_gpu_states()
+
+
+class CoroutineMock(mock.MagicMock):
+
+    async def __call__(self, *args, **kwargs):
+        return super().__call__(*args, **kwargs)
+
+
+def mock_consumer(consumer):
+    consumer.channel_layer = mock.Mock(group_add=CoroutineMock(), group_discard=CoroutineMock())
+    consumer.channel_name = "kekse"
+    consumer.accept = CoroutineMock()
+    consumer.close = CoroutineMock()
+    consumer.send = CoroutineMock()
+    return consumer
+
+
+class ConsumerTests(TransactionTestCase):
 
     def setUp(self):
+        cache.clear()
         self.device = device_recipe.make()
         self.device_2 = device_recipe.make()
         self.user = mommy.make(User)
@@ -1382,37 +2466,402 @@ class ConsumerTests(TestCase):
             }
         }
 
-        self.consumer = GPUInfoUpdater(self.scope)
-        self.consumer.channel_layer = get_channel_layer()
-        self.consumer.channel_name = "kekse"
-        self.mock_method = mock.MagicMock(return_value=None)
-        self.consumer.accept = self.mock_method
+        self.consumer = mock_consumer(GPUInfoUpdater(self.scope))
+
+    def connect(self, device_name):
+        self.consumer.scope['url_route']['kwargs']['device_name'] = device_name
+        async_to_sync(self.consumer.connect)()
 
     def test_consumer_no_permission(self):
-        self.consumer.scope['url_route']['kwargs']['device_name'] = self.device_2.name
-        self.consumer.base_send = mock.MagicMock(return_value=None)
-        self.consumer.connect()
-        self.mock_method.assert_not_called()
+        self.connect(self.device_2.name)
+        self.consumer.accept.assert_not_called()
+        self.consumer.close.assert_called()
+        self.consumer.channel_layer.group_add.assert_not_called()
+
+    def test_consumer_unknown_device(self):
+        self.connect("unknown")
+        self.consumer.accept.assert_not_called()
+        self.consumer.close.assert_called()
 
     def test_consumer_permission(self):
-        self.consumer.scope['url_route']['kwargs']['device_name'] = self.device.name
-        self.consumer.connect()
-        self.mock_method.assert_called()
+        self.connect(self.device.name)
+        self.consumer.accept.assert_called()
+        self.consumer.channel_layer.group_add.assert_called_with(self.device.name, self.consumer.channel_name)
+        self.consumer.send.assert_called_with(text_data=json.dumps(self.device.serialize()))
+
+    def test_consumer_serves_published_state(self):
+        with mock.patch('labshare.utils.async_to_sync', async_to_sync_mock):
+            publish_device_state(self.device)
+        published_state = self.device.serialize()
+        mommy.make(GPUProcess, gpu=self.device.gpus.first())
+
+        with CaptureQueriesContext(connection) as context:
+            self.connect(self.device.name)
+        self.consumer.send.assert_called_with(text_data=json.dumps(published_state))
+        self.assertFalse([query for query in context.captured_queries if "labshare_gpu" in query["sql"]])
+
+    @mock.patch('labshare.utils.async_to_sync', async_to_sync_mock)
+    def test_consumer_publishes_unpublished_state(self):
+        send_function_mock.reset_mock()
+        self.connect(self.device.name)
+        message = json.dumps(self.device.serialize())
+        send_function_mock.assert_called_once_with(self.device.name, {'type': 'update_info', 'message': message})
+        self.consumer.send.assert_called_with(text_data=message)
+        self.assertEqual(cache.get(published_device_state_key(self.device)), message)
+
+    def test_consumer_reads_state_after_joining_group(self):
+        def get_device_states(devices):
+            self.consumer.channel_layer.group_add.assert_called_with(self.device.name, self.consumer.channel_name)
+            return [(self.device.name, "state")]
+
+        with mock.patch("labshare.consumers.get_device_states", side_effect=get_device_states) as states_mock:
+            self.connect(self.device.name)
+        states_mock.assert_called_once_with([self.device])
+        self.consumer.send.assert_called_with(text_data="state")
 
-    @mock.patch('labshare.consumers.async_to_sync', async_to_sync_mock)
     def test_consumer_disconnect(self):
         device_name = "Lorem-Device"
         self.consumer.device_name = device_name
-        self.consumer.disconnect("lorem ipsum")
-        send_function_mock.assert_called_with(device_name, self.consumer.channel_name)
+        async_to_sync(self.consumer.disconnect)("lorem ipsum")
+        self.consumer.channel_layer.group_discard.assert_called_with(device_name, self.consumer.channel_name)
 
     def test_consumer_update_info(self):
         message = "Lorem Ipsum"
-        self.consumer.send = mock.MagicMock()
-        self.consumer.update_info({"message": message})
+        async_to_sync(self.consumer.update_info)({"message": message})
         self.consumer.send.assert_called_with(text_data=message)
 
 
+class DevicesConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.device = device_recipe.make()
+        self.device_2 = device_recipe.make()
+        self.device_3 = device_recipe.make()
+        self.user = mommy.make(User)
+        assign_perm('labshare.use_device', self.user, self.device)
+        assign_perm('labshare.use_device', self.user, self.device_3)
+
+        mommy.make(GPU, device=self.device, _quantity=2)
+        mommy.make(GPU, device=self.device_2, _quantity=2)
+
+        self.consumer = mock_consumer(DevicesInfoUpdater({"user": self.user}))
+
+    def test_consumer_subscribes_usable_devices(self):
+        async_to_sync(self.consumer.connect)()
+        self.consumer.accept.assert_called()
+        self.assertEqual(self.consumer.channel_layer.group_add.call_args_list, [
+            mock.call(self.device.name, self.consumer.channel_name),
+            mock.call(self.device_3.name, self.consumer.channel_name),
+        ])
+        self.assertEqual(self.consumer.send.call_args_list, [
+            mock.call(text_data=json.dumps(self.device.serialize())),
+            mock.call(text_data=json.dumps(self.device_3.serialize())),
+        ])
+
+    def test_consumer_reads_states_after_joining_groups(self):
+        def get_device_states(devices):
+            self.assertEqual(self.consumer.channel_layer.group_add.call_count, 2)
+            return [(device.name, device.name) for device in devices]
+
+        with mock.patch("labshare.consumers.get_device_states", side_effect=get_device_states):
+            async_to_sync(self.consumer.connect)()
+        self.assertEqual(self.consumer.send.call_count, 2)
+
+    def test_consumer_skips_known_versions(self):
+        device_states = dict(get_device_states(get_usable_devices(self.user)))
+        versions = {
+            self.device.name: device_state_version(device_states[self.device.name]),
+            self.device_3.name: "outdated",
+        }
+        self.consumer.scope["query_string"] = urlencode({"versions": json.dumps(versions)}).encode('utf-8')
+
+        async_to_sync(self.consumer.connect)()
+        self.assertEqual(len(self.consumer.channel_layer.group_add.call_args_list), 2)
+        self.consumer.send.assert_called_once_with(text_data=device_states[self.device_3.name])
+
+    def test_consumer_malformed_versions(self):
+        self.consumer.scope["query_string"] = b"versions=no-json"
+        async_to_sync(self.consumer.connect)()
+        self.assertEqual(len(self.consumer.send.call_args_list), 2)
+
+    def test_consumer_without_usable_devices(self):
+        self.consumer.scope["user"] = mommy.make(User)
+        async_to_sync(self.consumer.connect)()
+        self.consumer.accept.assert_called()
+        self.consumer.channel_layer.group_add.assert_not_called()
+        self.consumer.send.assert_not_called()
+
+    def test_consumer_disconnect(self):
+        async_to_sync(self.consumer.connect)()
+        async_to_sync(self.consumer.disconnect)("lorem ipsum")
+        self.assertEqual(self.consumer.channel_layer.group_discard.call_args_list, [
+            mock.call(self.device.name, self.consumer.channel_name),
+            mock.call(self.device_3.name, self.consumer.channel_name),
+        ])
+
+    def test_consumer_update_info(self):
+        async_to_sync(self.consumer.update_info)({"message": "Lorem Ipsum"})
+        self.consumer.send.assert_called_with(text_data="Lorem Ipsum")
+
+
+# the GPU daemon and the reservation scheduler must not use the channel layer of a running instance
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class GPUDaemonTests(TestCase):
+
+    def test_daemon_runs_all_stages_until_sigterm(self):
+        calls = []
+
+        def stage(name):
+            def run(*args, **kwargs):
+                calls.append(name)
+                if name == "reservations":
+                    os.kill(os.getpid(), signal.SIGTERM)
+            return run
+
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        stdout = io.StringIO()
+        with mock.patch.multiple(
+                "labshare.management.commands.gpu_daemon",
+                update_gpu_info=stage("update"),
+                determine_failed_gpus=stage("failed_gpus"),
+                publish_gpu_states=stage("publish"),
+                check_reservations=stage("reservations")):
+            call_command("gpu_daemon", stdout=stdout)
+
+        self.assertEqual(calls, ["update", "failed_gpus", "publish", "reservations"])
+        self.assertIn("GPU daemon stopped", stdout.getvalue())
+        self.assertNotIn("reservation scheduler", [thread.name for thread in threading.enumerate()])
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous_handler)
+
+    def test_daemon_stages_run_in_their_own_interval(self):
+        calls = []
+
+        def stage(name):
+            def run(*args, **kwargs):
+                calls.append(name)
+                if calls.count("update") == 3:
+                    os.kill(os.getpid(), signal.SIGTERM)
+            return run
+
+        with mock.patch.multiple(
+                "labshare.management.commands.gpu_daemon",
+                update_gpu_info=stage("update"),
+                determine_failed_gpus=stage("failed_gpus"),
+                publish_gpu_states=stage("publish"),
+                check_reservations=stage("reservations")):
+            call_command(
+                "gpu_daemon",
+                update_interval=0.05,
+                failed_gpus_interval=60,
+                publish_interval=60,
+                reservations_interval=60,
+                stdout=io.StringIO()
+            )
+
+        self.assertEqual(calls.count("update"), 3)
+        for name in ["failed_gpus", "publish", "reservations"]:
+            self.assertEqual(calls.count(name), 1)
+
+    def test_daemon_survives_failing_stage(self):
+        calls = []
+
+        def failing_update(*args, **kwargs):
+            calls.append("update")
+            if len(calls) == 2:
+                os.kill(os.getpid(), signal.SIGTERM)
+            raise ValueError("update failed")
+
+        with mock.patch.multiple(
+                "labshare.management.commands.gpu_daemon",
+                update_gpu_info=failing_update,
+                determine_failed_gpus=mock.DEFAULT,
+                publish_gpu_states=mock.DEFAULT,
+                check_reservations=mock.DEFAULT), mock.patch("sys.stderr", io.StringIO()):
+            call_command("gpu_daemon", update_interval=0.05, stdout=io.StringIO())
+
+        self.assertEqual(len(calls), 2)
+
+
+    def test_daemon_checks_reservation_when_it_expires(self):
+        reservation = mommy.make(Reservation, user=mommy.make(User), extension_reminder_sent=True)
+        reservation.start_usage()
+        reservation.usage_expires = utc_now() + timedelta(seconds=0.2)
+        reservation.save()
+        checked_reservations = []
+
+        def scheduled_check(reservation_ids=None):
+            if reservation_ids is not None:
+                checked_reservations.append((reservation_ids, utc_now()))
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        with mock.patch.multiple(
+                "labshare.management.commands.gpu_daemon",
+                update_gpu_info=mock.DEFAULT,
+                determine_failed_gpus=mock.DEFAULT,
+                publish_gpu_states=mock.DEFAULT,
+                check_reservations=scheduled_check):
+            call_command(
+                "gpu_daemon",
+                update_interval=60,
+                failed_gpus_interval=60,
+                publish_interval=60,
+                reservations_interval=60,
+                stdout=io.StringIO()
+            )
+
+        self.assertEqual(len(checked_reservations), 1)
+        reservation_ids, checked_at = checked_reservations[0]
+        self.assertEqual(reservation_ids, {reservation.pk})
+        self.assertGreaterEqual(checked_at, reservation.usage_expires)
+
+
+class ThreadSafeInMemoryChannelLayer(InMemoryChannelLayer):
+    """
+    The reservation scheduler receives on the event loop of its own thread, which does not notice messages that other
+    threads put into the in-memory queues. They are handed over to that loop instead.
+    """
+    receive_loop = None
+
+    async def receive(self, channel):
+        self.receive_loop = asyncio.get_event_loop()
+        try:
+            return await super().receive(channel)
+        finally:
+            self.receive_loop = None
+
+    async def send(self, channel, message):
+        loop = self.receive_loop
+        if loop is None or loop is asyncio.get_event_loop():
+            return await super().send(channel, message)
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(super().send(channel, message), loop))
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'labshare.tests.ThreadSafeInMemoryChannelLayer'}})
+class ReservationSchedulerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = mommy.make(User)
+        self.scheduler = ReservationScheduler()
+        # drops the changes other tests sent to the scheduler
+        async_to_sync(get_channel_layer().flush)()
+
+    def test_rebuild_from_database(self):
+        expiring = make_reservation_in_the_past(self.user, mommy.make(GPU), timedelta(days=1))
+        reminded = make_reservation_in_the_past(self.user, mommy.make(GPU), timedelta(days=7))
+        reminded.set_reminder_sent()
+        mommy.make(Reservation, user=self.user)
+
+        self.scheduler.rebuild()
+        self.assertEqual(self.scheduler.expiries, {
+            expiring.pk: expiring.usage_expires,
+            reminded.pk: reminded.usage_expires,
+        })
+        self.assertAlmostEqual(self.scheduler.seconds_until_next(), timedelta(days=1).total_seconds(), delta=5)
+
+        with mock.patch("django.utils.timezone.now") as mock_now:
+            mock_now.return_value = utc_now() + timedelta(days=2)
+            self.assertEqual(self.scheduler.pop_due(), {reminded.pk})
+            mock_now.return_value = utc_now() + timedelta(days=5, hours=12)
+            self.assertEqual(self.scheduler.pop_due(), {expiring.pk})
+            mock_now.return_value = utc_now() + timedelta(days=8)
+            self.assertEqual(self.scheduler.pop_due(), {expiring.pk})
+        self.assertIsNone(self.scheduler.seconds_until_next())
+        self.assertEqual(self.scheduler.expiries, {})
+
+    def test_outdated_entries_are_skipped(self):
+        usage_expires = utc_now() + timedelta(hours=1)
+        self.scheduler.add(1, usage_expires, extension_reminder_sent=True)
+        self.scheduler.add(1, usage_expires + Reservation.usage_period(), extension_reminder_sent=False)
+
+        with mock.patch("django.utils.timezone.now") as mock_now:
+            mock_now.return_value = usage_expires
+            self.assertEqual(self.scheduler.pop_due(), set())
+            mock_now.return_value = usage_expires + Reservation.usage_period() - Reservation.reminder_period()
+            self.assertEqual(self.scheduler.pop_due(), {1})
+
+    def test_outdated_change_ignored(self):
+        usage_expires = utc_now() + timedelta(hours=1)
+        self.scheduler.add(1, usage_expires + timedelta(days=8), extension_reminder_sent=True)
+        # e.g. the notification of the start of the usage arrives after the one of its extension
+        self.scheduler.add(1, usage_expires, extension_reminder_sent=False)
+        self.assertEqual(self.scheduler.expiries, {1: usage_expires + timedelta(days=8)})
+        self.assertEqual(len(self.scheduler.heap), 1)
+
+    def test_changes_during_rebuild_kept(self):
+        reservation = make_reservation_in_the_past(self.user, mommy.make(GPU), timedelta(days=1))
+        extended_expiry = reservation.usage_expires + timedelta(days=1)
+        new_expiry = utc_now() + Reservation.usage_period()
+        filter_reservations = Reservation.objects.filter
+
+        def filter_during_changes(*args, **kwargs):
+            # the notifications arrive while the database is queried, the query still sees the old expiry
+            self.scheduler.add(reservation.pk, extended_expiry)
+            self.scheduler.add(4242, new_expiry)
+            return filter_reservations(*args, **kwargs)
+
+        with mock.patch.object(Reservation.objects, "filter", side_effect=filter_during_changes):
+            self.scheduler.rebuild()
+        self.assertEqual(self.scheduler.expiries, {reservation.pk: extended_expiry, 4242: new_expiry})
+        self.assertIsNone(self.scheduler.changes_during_rebuild)
+
+    def test_start_usage_and_extend_notify_scheduler(self):
+        reservation = mommy.make(Reservation, user=self.user)
+        channel_layer = get_channel_layer()
+        wake_event = threading.Event()
+        listener = threading.Thread(target=self.scheduler.listen, args=(channel_layer, threading.Event(), wake_event))
+        listener.start()
+        try:
+            reservation.start_usage()
+            self.assertTrue(wake_event.wait(5))
+            self.assertEqual(self.scheduler.expiries, {reservation.pk: reservation.usage_expires})
+
+            wake_event.clear()
+            reservation.usage_expires = utc_now() + timedelta(hours=1)
+            reservation.extend()
+            self.assertTrue(wake_event.wait(5))
+            self.assertEqual(self.scheduler.expiries, {reservation.pk: reservation.usage_expires})
+        finally:
+            self.scheduler.stop_listening(channel_layer)
+            listener.join()
+
+    def test_listener_only_stopped_by_own_stop_message(self):
+        channel_layer = get_channel_layer()
+        listener = threading.Thread(
+            target=self.scheduler.listen, args=(channel_layer, threading.Event(), threading.Event())
+        )
+        listener.start()
+        self.assertTrue(self.scheduler.listening.wait(5))
+
+        other_scheduler = ReservationScheduler()
+        async_to_sync(channel_layer.send)(
+            RESERVATION_SCHEDULER_CHANNEL, {'type': STOP_LISTENING_TYPE, 'listener': other_scheduler.listener_id}
+        )
+        listener.join(0.2)
+        self.assertTrue(listener.is_alive())
+
+        self.scheduler.stop_listening(channel_layer)
+        listener.join(5)
+        self.assertFalse(listener.is_alive())
+
+    @mock.patch("labshare.signals.notify_reservation_scheduler")
+    def test_scheduler_only_notified_of_new_expiry(self, notify_mock):
+        reservation = mommy.make(Reservation, user=self.user)
+        reservation.set_reminder_sent()
+        notify_mock.assert_not_called()
+
+        reservation.start_usage()
+        notify_mock.assert_called_once_with(reservation)
+
+    @mock.patch("labshare.signals.notify_reservation_scheduler")
+    def test_scheduler_notified_after_commit(self, notify_mock):
+        reservation = mommy.make(Reservation, user=self.user)
+        with transaction.atomic():
+            reservation.start_usage()
+            notify_mock.assert_not_called()
+        notify_mock.assert_called_once_with(reservation)
+
+
 ldap_staff_name = "Staff"
 ldap_student_name = "Student"
 
@@ -1,18 +1,30 @@
 import sys
+from datetime import timedelta
 
 import channels.layers
+import gzip
+import hashlib
+import http.client
 import json
-import urllib.request
+import threading
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
 from asgiref.sync import async_to_sync
 from django.conf import settings
 
-from django.core.mail import send_mail, EmailMessage
+from django.core.cache import cache
+from django.core.mail import send_mail, EmailMessage, get_connection
+from django.db import connections, router, transaction
+from django.db.models import F, Q
 from django.http import HttpResponse
 from django.shortcuts import render
 from django.template import loader
+from django.utils import timezone
 from urllib.error import URLError
 
 from .models import Device, GPU, GPUProcess, Reservation
+from .reservation_queue import end_expired_reservation
 
 
 def get_devices():
@@ -21,7 +33,7 @@ def get_devices():
 
 def send_reservation_mail_for(request, gpu):
     if gpu.reservations.count() > 1:
-        current_reservation = gpu.reservations.order_by("time_reserved").first()
+        current_reservation = gpu.current_reservation()
         email_addresses = [address.email for address in current_reservation.user.email_addresses.all()]
         email_addresses.append(current_reservation.user.email)
         send_mail(
@@ -35,30 +47,11 @@ def send_reservation_mail_for(request, gpu):
         )
 
 
-def delete_reservation(reservation):
-    gpu = reservation.gpu
-    reservation.delete()
-
-    # get the user of the reservation that is now current and send him an email
-    current_reservation = gpu.current_reservation()
-    if current_reservation is not None:
-        current_reservation.start_usage()
-        # clear all reservations made for this user if he only reserved the next available spot on this device
-        if current_reservation.user_reserved_next_available_spot:
-            device = current_reservation.gpu.device
-            reservations_to_delete = []
-            for gpu in device.gpus.all():
-                for reservation in gpu.reservations.all():
-                    if reservation == current_reservation:
-                        continue
-                    elif reservation.user == current_reservation.user and reservation.user_reserved_next_available_spot:
-                        reservations_to_delete.append(reservation)
-
-            for reservation in reservations_to_delete:
-                reservation.delete()
-
-        send_gpu_done_mail(gpu, current_reservation)
-    publish_device_state(gpu.device)
+def reservation_ended(gpu, queue):
+    # the reservation that is now current was started, so its user can use the gpu
+    if queue:
+        send_gpu_done_mail(gpu, queue[0])
+    schedule_device_publish(gpu.device)
 
 
 def send_gpu_done_mail(gpu, reservation):
@@ -94,102 +87,477 @@ def login_required_ajax(function=None, redirect_field_name=None):
         return _decorator(function)
 
 
-def update_gpu_info():
-    for device in Device.objects.all():
+class AgentConnectionPool:
+    """
+    Keeps the HTTP connection to every device_query agent open after a request, so that the next update cycle can
+    reuse it. A connection is only used by one request at a time.
+    """
+
+    def __init__(self, port=12000):
+        self.port = port
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def request(self, address, timeout, headers=None):
+        """
+        Sends a GET request to the agent at the given address and returns the response together with its body.
+        """
+        with self.lock:
+            connection = self.connections.pop(address, None)
+
+        if connection is not None:
+            try:
+                return self.send(address, connection, timeout, headers)
+            except (http.client.HTTPException, ConnectionError):
+                # the agent closed the connection since we used it last time, so we try again with a new one
+                pass
+        return self.send(address, http.client.HTTPConnection(address, self.port, timeout=timeout), timeout, headers)
+
+    def send(self, address, connection, timeout, headers):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
         try:
-            ip_address = device.ip_address
-            response = urllib.request.urlopen("http://{}:12000".format(ip_address), timeout=10).read().decode('utf-8')
-            gpus = json.loads(response)
-            for gpu_data in gpus:
-                gpu = GPU.objects.filter(device=device, uuid=gpu_data["uuid"])
-
-                gpu_in_use = True if gpu_data.get("in_use", "na") == "yes" else False
-                if gpu_data.get("in_use", "na") == "na":
-                    # assume that device is in use if more than 800 MiB of video ram are in use
-                    gpu_in_use = int(gpu_data["memory"]["used"].split()[0]) > 800
-
-                if not gpu.exists():
-                    gpu = GPU(
-                        device=device,
-                        model_name=gpu_data["name"],
-                        uuid=gpu_data["uuid"],
-                        used_memory=gpu_data["memory"]["used"],
-                        total_memory=gpu_data["memory"]["total"],
-                        in_use=gpu_in_use,
-                    )
-                else:
-                    gpu = gpu.get()
-                    memory_info = gpu_data["memory"]
-                    gpu.used_memory = memory_info["used"]
-                    gpu.total_memory = memory_info["total"]
-                    gpu.in_use = gpu_in_use
-                    gpu.marked_as_failed = False
-                gpu.save()
-
-                gpu.processes.all().delete()
-                if gpu_in_use:
-                    # save processes if this is supported by the GPU
-                    for process in gpu_data.get('processes', []):
-                        GPUProcess(
-                            gpu=gpu,
-                            name=process.get("name", "Unknown"),
-                            pid=int(process.get("pid", "0")),
-                            memory_usage=process.get("used_memory", "Unknown"),
-                            username=process.get("username", "Unknown"),
-                        ).save()
+            connection.request("GET", "/", headers=headers or {})
+            response = connection.getresponse()
+            body = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                self.connections[address] = connection
+        return response, body
+
+
+agent_connections = AgentConnectionPool()
+
+
+AGENT_COMPACT_CONTENT_TYPE = "application/vnd.labshare.compact+json"
+
+
+def memory_in_mib(value):
+    # we store memory values the way nvidia-smi reports them
+    if value is None:
+        return "N/A"
+    return "{} MiB".format(value // 1024 ** 2)
+
+
+def decode_gpu_info(body, content_type=None, content_encoding=None):
+    """
+    Decodes GPU data sent by a device_query agent, either in the original format or in the compact format that
+    reports memory values as number of bytes.
+    """
+    if content_encoding == "gzip":
+        try:
+            body = gzip.decompress(body)
+        except (EOFError, zlib.error) as e:
+            # truncated or corrupt streams, invalid headers already raise an OSError
+            raise ValueError("invalid gzip data: {}".format(e))
+    gpus = json.loads(body.decode('utf-8'))
+
+    if (content_type or "").startswith(AGENT_COMPACT_CONTENT_TYPE):
+        for gpu_data in gpus:
+            gpu_data["memory"] = {key: memory_in_mib(value) for key, value in gpu_data["memory"].items()}
+            for process in gpu_data.get("processes", []):
+                process["used_memory"] = memory_in_mib(process.get("used_memory"))
+    return gpus
+
+
+def fetch_gpu_info(device, timeout):
+    """
+    Returns the ETag and the GPU data reported by the agent of the given device. The GPU data is None if it did not
+    change since it was stored the last time.
+    """
+    # agents that do not know the compact format or gzip ignore these headers and answer in the original format
+    headers = {"Accept": AGENT_COMPACT_CONTENT_TYPE, "Accept-Encoding": "gzip"}
+    if device.agent_etag:
+        headers["If-None-Match"] = device.agent_etag
+    response, body = agent_connections.request(device.ip_address, timeout, headers=headers)
+    if response.status == 304:
+        return device.agent_etag, None
+    if response.status != 200:
+        raise http.client.HTTPException("agent answered with {} {}".format(response.status, response.reason))
+    return response.getheader("ETag", ""), decode_gpu_info(
+        body, response.getheader("Content-Type"), response.getheader("Content-Encoding")
+    )
+
+
+def poll_devices(devices, executor=None):
+    """
+    Query the device_query agents of all given devices concurrently.
+
+    At most GPU_UPDATE_CONCURRENCY agents are queried at the same time, each with a timeout of
+    GPU_UPDATE_HOST_TIMEOUT seconds. Agents that did not answer GPU_UPDATE_DEADLINE seconds after the poll started
+    are skipped for this cycle. Returns a list of (device, ETag, gpu data) tuples for all devices that answered in
+    time, see fetch_gpu_info.
+    Long running callers can pass their own executor, so that its worker threads are reused across cycles.
+    """
+    if len(devices) == 0:
+        return []
+
+    shared_executor = executor is not None
+    if not shared_executor:
+        executor = ThreadPoolExecutor(max_workers=min(settings.GPU_UPDATE_CONCURRENCY, len(devices)))
+    futures = [
+        (device, executor.submit(fetch_gpu_info, device, settings.GPU_UPDATE_HOST_TIMEOUT)) for device in devices
+    ]
+    done, not_done = wait([future for _, future in futures], timeout=settings.GPU_UPDATE_DEADLINE)
+    if not shared_executor:
+        # do not wait for hosts that missed the deadline, their requests end on their own after the host timeout
+        executor.shutdown(wait=False)
+
+    results = []
+    for device, future in futures:
+        if future in not_done:
+            future.cancel()
+            print("{}: no answer within {} seconds".format(device, settings.GPU_UPDATE_DEADLINE), file=sys.stderr)
+            continue
+        try:
+            results.append((device,) + future.result())
+        except Exception as e:
+            print("{}: {}".format(device, e), file=sys.stderr)
+    return results
+
+
+def gpu_in_use(gpu_data):
+    if gpu_data.get("in_use", "na") == "na":
+        # assume that device is in use if more than 800 MiB of video ram are in use
+        return int(gpu_data["memory"]["used"].split()[0]) > 800
+    return gpu_data["in_use"] == "yes"
+
+
+def process_key(gpu_uuid, name, pid, memory_usage, username):
+    return gpu_uuid, name, int(pid), memory_usage, username
+
+
+def apply_gpu_info(device, gpus):
+    """
+    Store the GPU data reported by the device_query agent of the given device.
+
+    The reported data is compared to the stored state of the device and only the differences are written, using a
+    fixed number of bulk queries per device regardless of the number of GPUs and processes. Returns whether anything
+    besides the time of the last update changed. Raises a ValueError if a reported GPU belongs to another device.
+    """
+    now = timezone.now()
+    stored_gpus = {gpu.uuid: gpu for gpu in GPU.objects.filter(device=device)}
+
+    new_gpus = []
+    changed_gpus = []
+    unchanged_gpus = []
+    reported_processes = Counter()
+    for gpu_data in gpus:
+        in_use = gpu_in_use(gpu_data)
+        memory_info = gpu_data["memory"]
+        gpu = stored_gpus.get(gpu_data["uuid"])
+        if gpu is None:
+            new_gpus.append(GPU(
+                device=device,
+                model_name=gpu_data["name"],
+                uuid=gpu_data["uuid"],
+                used_memory=memory_info["used"],
+                total_memory=memory_info["total"],
+                in_use=in_use,
+            ))
+        elif (gpu.used_memory, gpu.total_memory, gpu.in_use, gpu.marked_as_failed) != \
+                (memory_info["used"], memory_info["total"], in_use, False):
+            gpu.used_memory = memory_info["used"]
+            gpu.total_memory = memory_info["total"]
+            gpu.in_use = in_use
+            gpu.marked_as_failed = False
+            gpu.last_updated = now
+            changed_gpus.append(gpu)
+        else:
+            unchanged_gpus.append(gpu)
+
+        if in_use:
+            # save processes if this is supported by the GPU
+            for process in gpu_data.get('processes', []):
+                reported_processes[process_key(
+                    gpu_data["uuid"],
+                    process.get("name", "Unknown"),
+                    process.get("pid", "0"),
+                    process.get("used_memory", "Unknown"),
+                    process.get("username", "Unknown"),
+                )] += 1
+
+    if len(new_gpus) > 0 and GPU.objects.filter(uuid__in=[gpu.uuid for gpu in new_gpus]).exists():
+        raise ValueError("GPU reported by {} belongs to another device".format(device.name))
+
+    with transaction.atomic():
+        if len(new_gpus) > 0:
+            GPU.objects.bulk_create(new_gpus)
+            # not every database backend sets the primary keys of bulk created objects
+            stored_gpus.update({
+                gpu.uuid: gpu for gpu in GPU.objects.filter(device=device, uuid__in=[gpu.uuid for gpu in new_gpus])
+            })
+        if len(changed_gpus) > 0:
+            GPU.objects.bulk_update(
+                changed_gpus, ["used_memory", "total_memory", "in_use", "marked_as_failed", "last_updated"]
+            )
+        if len(unchanged_gpus) > 0:
+            GPU.objects.filter(id__in=[gpu.id for gpu in unchanged_gpus]).update(last_updated=now)
+
+        # processes that are still running are kept, all others are replaced by the newly reported processes
+        reported_uuids = [gpu_data["uuid"] for gpu_data in gpus]
+        outdated_processes = []
+        for process in GPUProcess.objects.filter(gpu__device=device, gpu__uuid__in=reported_uuids).select_related("gpu"):
+            key = process_key(process.gpu.uuid, process.name, process.pid, process.memory_usage, process.username)
+            if reported_processes[key] > 0:
+                reported_processes[key] -= 1
+            else:
+                outdated_processes.append(process.id)
+        if len(outdated_processes) > 0:
+            GPUProcess.objects.filter(id__in=outdated_processes).delete()
+
+        new_processes = [
+            GPUProcess(gpu=stored_gpus[uuid], name=name, pid=pid, memory_usage=memory_usage, username=username)
+            for (uuid, name, pid, memory_usage, username), count in reported_processes.items()
+            for _ in range(count)
+        ]
+        if len(new_processes) > 0:
+            GPUProcess.objects.bulk_create(new_processes)
+
+    return len(new_gpus) + len(changed_gpus) + len(outdated_processes) + len(new_processes) > 0
+
+
+def refresh_unchanged_gpus(device):
+    # nothing changed on this device, so we only make sure that its GPUs are not considered as failed
+    now = timezone.now()
+    GPU.objects.filter(device=device).filter(
+        Q(last_updated__lt=now - timedelta(minutes=5)) | Q(marked_as_failed=True)
+    ).update(last_updated=now, marked_as_failed=False)
+
+
+def update_gpu_info(executor=None):
+    # all agents are queried in parallel, only the database updates are performed one after another
+    # devices with a push token send their GPU info on their own and are not polled
+    for device, etag, gpus in poll_devices(list(Device.objects.filter(push_token="")), executor=executor):
+        try:
+            if gpus is None:
+                refresh_unchanged_gpus(device)
+                continue
+            with transaction.atomic():
+                apply_gpu_info(device, gpus)
+                if etag != device.agent_etag:
+                    device.agent_etag = etag
+                    device.save(update_fields=["agent_etag"])
         except Exception as e:
             print(e, file=sys.stderr)
 
 
 def determine_failed_gpus():
     # gather all GPUs that have not been updated in a while and notify users + admin of possible problems
-    failed_gpus = filter(lambda gpu: gpu.last_update_too_long_ago() and not gpu.marked_as_failed, GPU.objects.all())
-    for failed_gpu in failed_gpus:
-        # 1. gather all email addresses
-        admin_emails = [data[1] for data in settings.ADMINS]
-
-        current_user = failed_gpu.get_current_user()
+    threshold = timezone.now() - timedelta(minutes=30)
+    with transaction.atomic():
+        # the failed GPUs stay locked until they are marked, so that a GPU that reports again in the meantime is
+        # neither marked as failed nor mentioned in the emails
+        stale_gpus = GPU.objects.filter(last_updated__lt=threshold, marked_as_failed=False)
+        if not connections[router.db_for_write(GPU)].features.has_select_for_update:
+            # SQLite ignores SELECT ... FOR UPDATE, but any write locks the database until the end of the transaction
+            stale_gpus.update(in_use=F("in_use"))
+        failed_gpus = list(
+            stale_gpus.select_for_update(of=("self",))
+            .select_related("device")
+            .with_reservations()
+            .prefetch_related("reservations__user__email_addresses")
+        )
+        if len(failed_gpus) == 0:
+            return
+
+        # mark the GPUs as failed to inhibit further emails
+        GPU.objects.filter(
+            pk__in=[failed_gpu.pk for failed_gpu in failed_gpus], last_updated__lt=threshold, marked_as_failed=False
+        ).update(marked_as_failed=True)
+
+    # 1. group the failed GPUs by their current user
+    failed_gpus_with_users = [(failed_gpu, failed_gpu.get_current_user()) for failed_gpu in failed_gpus]
+    failed_gpus_of_users = {}
+    for failed_gpu, current_user in failed_gpus_with_users:
         if current_user is not None:
-            current_user_emails = [address.email for address in current_user.email_addresses.all()]
-            current_user_emails.append(current_user.email)
-        else:
-            current_user_emails = admin_emails
-
-        # 2. prepare and send email
-        email_template = loader.get_template('mails/gpu_problem.txt')
-        email = EmailMessage(
+            failed_gpus_of_users.setdefault(current_user, []).append(failed_gpu)
+
+    # 2. send one email per user that lists all of their failed GPUs and one email to the admins that lists all
+    email_template = loader.get_template('mails/gpu_problem.txt')
+    emails = []
+    for current_user, gpus in failed_gpus_of_users.items():
+        current_user_emails = [address.email for address in current_user.email_addresses.all()]
+        current_user_emails.append(current_user.email)
+        emails.append(EmailMessage(
             subject="[Labshare] Problem with GPU",
-            body=email_template.render({'user': current_user, "gpu": failed_gpu}),
+            body=email_template.render({'user': current_user, "gpus": gpus}),
             from_email=settings.DEFAULT_FROM_EMAIL,
             to=current_user_emails,
-            cc=admin_emails,
-        )
-        email.send()
+        ))
 
-        # 3. mark gpu as failed and inhibit further emails
-        failed_gpu.marked_as_failed = True
-        failed_gpu.save(update_fields=["marked_as_failed"])
+    admin_emails = [data[1] for data in settings.ADMINS]
+    if admin_emails:
+        emails.append(EmailMessage(
+            subject="[Labshare] Problem with GPU",
+            body=loader.get_template('mails/gpu_problem_admins.txt').render({"failed_gpus": failed_gpus_with_users}),
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=admin_emails,
+        ))
+    get_connection().send_messages(emails)
 
 
-def publish_device_state(device, channel_name=None):
+def published_device_state_key(device):
+    return "labshare:published_device_state:{}".format(device.pk)
+
+
+def gpu_state_delta(previous_data, device_data):
+    """
+    Returns the GPUs of device_data that changed since previous_data, each reduced to its uuid and the fields that
+    changed, or None if GPUs were added or removed.
+    """
+    previous_gpus = {gpu["uuid"]: gpu for gpu in previous_data["gpus"]}
+    if set(previous_gpus) != {gpu["uuid"] for gpu in device_data["gpus"]}:
+        return None
+
+    delta = []
+    for gpu in device_data["gpus"]:
+        changed_fields = {key: value for key, value in gpu.items() if previous_gpus[gpu["uuid"]].get(key) != value}
+        if changed_fields:
+            changed_fields["uuid"] = gpu["uuid"]
+            delta.append(changed_fields)
+    return delta
+
+
+def send_device_state(name, message, channel_name=None):
     channel_layer = channels.layers.get_channel_layer()
-    name = device.name
-    device_data = device.serialize()
     if channel_name is None:
         send_function = async_to_sync(channel_layer.group_send)
     else:
         send_function = async_to_sync(channel_layer.send)
-    send_function(channel_name if channel_name else name, {'type': 'update_info', 'message': json.dumps(device_data)})
+    send_function(channel_name if channel_name else name, {'type': 'update_info', 'message': message})
+
+
+def publish_device_state(device, channel_name=None):
+    message = json.dumps(device.serialize())
+    if channel_name is None:
+        cache.set(published_device_state_key(device), message, settings.PUBLISHED_DEVICE_STATE_TIMEOUT)
+    send_device_state(device.name, message, channel_name=channel_name)
+    return message
+
+
+class DevicePublisher:
+    """
+    Coalesces requests to publish the state of a device. All devices that are scheduled within GPU_PUBLISH_DELAY
+    seconds are published together and each of them is serialized and encoded only once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.timer = None
+
+    def schedule(self, device):
+        # the state has to be read after the change that triggered the publish is committed
+        transaction.on_commit(lambda: self.add(device.pk))
+
+    def add(self, device_pk):
+        with self.lock:
+            self.pending.add(device_pk)
+            if self.timer is None and settings.GPU_PUBLISH_DELAY > 0:
+                self.timer = threading.Timer(settings.GPU_PUBLISH_DELAY, self.publish_pending)
+                self.timer.daemon = True
+                self.timer.start()
+        if settings.GPU_PUBLISH_DELAY <= 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Publishes all scheduled devices right away.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            pending, self.pending, self.timer = self.pending, set(), None
+        if pending:
+            for device in Device.objects.with_gpu_state().filter(pk__in=pending):
+                publish_device_state(device)
+
+    def publish_pending(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print("Could not publish device states: {}".format(e), file=sys.stderr)
+        finally:
+            # the timer thread has its own database connection
+            connections.close_all()
+
+
+device_publisher = DevicePublisher()
+
+
+def schedule_device_publish(device):
+    device_publisher.schedule(device)
+
+
+def get_usable_devices(user, device_names=None):
+    devices = Device.objects.usable_by(user)
+    if device_names is not None:
+        devices = devices.filter(name__in=device_names)
+    return list(devices)
+
+
+def get_device_states(devices):
+    """
+    Returns the names and the serialized states of the given devices. The last published state of a device is used
+    if there is one, so that it fits the deltas that are published afterwards. Devices without a published state are
+    published, so that all clients are in sync.
+    """
+    published_states = cache.get_many([published_device_state_key(device) for device in devices])
+    unpublished_devices = Device.objects.with_gpu_state().filter(
+        pk__in=[device.pk for device in devices if published_device_state_key(device) not in published_states]
+    )
+    for device in unpublished_devices:
+        published_states[published_device_state_key(device)] = publish_device_state(device)
+
+    return [(device.name, published_states[published_device_state_key(device)]) for device in devices]
+
+
+def device_state_version(message):
+    return hashlib.sha1(message.encode('utf-8')).hexdigest()[:16]
 
 
 def publish_gpu_states():
-    devices = Device.objects.all()
+    """
+    Publishes the state of all devices whose state changed since it was published the last time. If enabled, only
+    the changed fields of the changed GPUs are sent.
+    """
+    devices = list(Device.objects.with_gpu_state())
+    published_states = cache.get_many([published_device_state_key(device) for device in devices])
 
+    changed_states = {}
+    messages = []
     for device in devices:
-        publish_device_state(device)
+        device_data = device.serialize()
+        message = json.dumps(device_data)
+        previous_message = published_states.get(published_device_state_key(device))
+        if message == previous_message:
+            continue
+        changed_states[published_device_state_key(device)] = message
+
+        delta = None
+        if previous_message is not None and settings.GPU_PUBLISH_DELTAS:
+            delta = gpu_state_delta(json.loads(previous_message), device_data)
+        if delta is None:
+            messages.append((device.name, message))
+        else:
+            messages.append((device.name, json.dumps({'name': device.name, 'delta': True, 'gpus': delta})))
+
+    # a client that connects in between gets the new state and possibly a delta it already contains, which is
+    # harmless, instead of the old state without the delta
+    cache.set_many(changed_states, settings.PUBLISHED_DEVICE_STATE_TIMEOUT)
+    for device_name, message in messages:
+        send_device_state(device_name, message)
 
 
-def send_extension_reminder(reservation):
+def send_extension_reminder(reservation, connection=None):
     email_addresses = [address.email for address in reservation.user.email_addresses.all()]
     email_addresses.append(reservation.user.email)
 
@@ -197,13 +565,17 @@ def send_extension_reminder(reservation):
         "GPU reservation is expiring",
         loader.get_template("mails/expiration_reminder.txt").render({'reservation': reservation, "gpu": reservation.gpu}),
         settings.DEFAULT_FROM_EMAIL,
-        email_addresses
+        email_addresses,
+        connection=connection,
     )
-    reservation.set_reminder_sent()
 
 
-def expire_reservation(reservation):
-    delete_reservation(reservation)
+def expire_reservation(reservation, connection=None):
+    queue = end_expired_reservation(reservation)
+    if queue is None:
+        return
+    reservation_ended(reservation.gpu, queue)
+
     email_addresses = [address.email for address in reservation.user.email_addresses.all()]
     email_addresses.append(reservation.user.email)
 
@@ -212,16 +584,43 @@ def expire_reservation(reservation):
         loader.get_template("mails/usage_expired.txt").render({'reservation': reservation, "gpu": reservation.gpu}),
         settings.DEFAULT_FROM_EMAIL,
         email_addresses,
+        connection=connection,
     )
 
 
-def check_reservations():
-    all_reservations = Reservation.objects.all()
-    for reservation in all_reservations:
-        if reservation.usage_started is None:
-            continue
-        if reservation.is_usage_expired():
-            expire_reservation(reservation)
-            continue
-        if reservation.needs_reminder():
-            send_extension_reminder(reservation)
+def check_reservations(reservation_ids=None):
+    """
+    Expires reservations whose usage period is over and reminds users of reservations that expire soon. Only the
+    reservations that need one of these actions are loaded. If reservation_ids is given, only these reservations are
+    checked.
+    """
+    now = timezone.now()
+    reservations = Reservation.objects.filter(usage_started__isnull=False).select_related(
+        "user", "gpu__device"
+    ).prefetch_related("user__email_addresses")
+    if reservation_ids is not None:
+        reservations = reservations.filter(pk__in=reservation_ids)
+    expired_reservations = reservations.filter(usage_expires__lt=now)
+    expiring_reservations = reservations.filter(
+        usage_expires__gte=now,
+        usage_expires__lt=now + Reservation.reminder_period(),
+        extension_reminder_sent=False,
+    )
+
+    # all mails of this run are sent over one connection
+    connection = get_connection()
+    for reservation in expired_reservations:
+        expire_reservation(reservation, connection=connection)
+
+    reminded_reservations = []
+    for reservation in expiring_reservations:
+        send_extension_reminder(reservation, connection=connection)
+        reminded_reservations.append(reservation.pk)
+    # reservations that were extended in the meantime still need a reminder for their new usage period
+    Reservation.objects.filter(
+        pk__in=reminded_reservations,
+        usage_expires__lt=now + Reservation.reminder_period(),
+    ).update(extension_reminder_sent=True)
+
+    # devices whose reservations expired are published together, once per device
+    device_publisher.flush()
@@ -1,3 +1,4 @@
+import hmac
 import json
 
 from django.contrib import messages
@@ -5,14 +6,18 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied, SuspiciousOperation
 from django.core.mail import EmailMessage
+from django.db.models import Prefetch
 from django.http import HttpResponseRedirect, HttpResponseBadRequest, HttpResponse, HttpResponseForbidden, Http404
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
-from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 
 from .forms import DeviceSelectForm, MessageForm, ViewAsForm
-from labshare.utils import send_reservation_mail_for, send_gpu_done_mail, login_required_ajax, publish_device_state, \
-    delete_reservation
+from labshare.reservation_queue import reserve_gpu, reserve_next_available_gpu, finish_reservation, \
+    cancel_reservation, extend_reservation
+from labshare.utils import send_reservation_mail_for, send_gpu_done_mail, login_required_ajax, \
+    schedule_device_publish, reservation_ended, apply_gpu_info, decode_gpu_info, get_device_states, \
+    device_state_version
 from .models import Device, Reservation, GPU
 from labshare.decorators import render_to
 
@@ -20,14 +25,20 @@ from labshare.decorators import render_to
 @ensure_csrf_cookie
 @render_to("overview.html")
 def index(request):
-    devices = list(filter(lambda device: device.can_be_used_by(request.user), Device.objects.all()))
-    return {"devices": devices}
+    devices = list(Device.objects.usable_by(request.user).prefetch_related("gpus"))
+    # the current state is embedded into the page, so the WebSocket only has to send updates
+    device_states = get_device_states(devices)
+    initial_state = {
+        "devices": [json.loads(device_state) for _, device_state in device_states],
+        "versions": {device_name: device_state_version(device_state) for device_name, device_state in device_states},
+    }
+    return {"devices": devices, "initial_state": initial_state}
 
 
 @login_required
 @render_to("reserve.html")
 def reserve(request):
-    accessible_devices = filter(lambda device: device.can_be_used_by(request.user), Device.objects.all())
+    accessible_devices = Device.objects.usable_by(request.user)
 
     form = DeviceSelectForm(request.POST or None, devices=accessible_devices)
     if form.is_valid():
@@ -35,34 +46,26 @@ def reserve(request):
         if json.loads(form.data.get("next-available-spot", "false")):
             if not device.can_be_used_by(request.user):
                 raise PermissionDenied
-            # first check whether a gpu is already available on that given machine
-            for gpu in device.gpus.all():
-                if gpu.reservations.count() is 0:
-                    reservation = Reservation(gpu=gpu, user=request.user)
-                    reservation.start_usage(save=False)
-                    reservation.save()
-                    send_gpu_done_mail(gpu, reservation)
-                    return HttpResponseRedirect(reverse("index"))
-
-            # if there is no gpu available right now reserve all on this device and mark them as special reservation
-            for gpu in device.gpus.all():
-                reservation = Reservation(gpu=gpu, user=request.user, user_reserved_next_available_spot=True)
-                reservation.save()
-                send_reservation_mail_for(request, gpu)
+            reservations = reserve_next_available_gpu(device, request.user)
+            # a gpu was available on the given machine
+            if len(reservations) == 1 and reservations[0].usage_started is not None:
+                send_gpu_done_mail(reservations[0].gpu, reservations[0])
+                schedule_device_publish(device)
+                return HttpResponseRedirect(reverse("index"))
+
+            # otherwise all gpus on this device were reserved and marked as special reservation
+            for reservation in reservations:
+                send_reservation_mail_for(request, reservation.gpu)
         else:
             gpu = get_object_or_404(GPU, uuid=form.data["gpu"])
             if not gpu.device.can_be_used_by(request.user):
                 raise PermissionDenied
-            start_usage = gpu.reservations.count() is 0
-            reservation = Reservation(gpu=gpu, user=request.user)
-            if start_usage:
-                reservation.start_usage(save=False)
-            reservation.save()
+            reserve_gpu(gpu, request.user)
 
             send_reservation_mail_for(request, gpu)
 
         # notify our users of this change for this device
-        publish_device_state(device)
+        schedule_device_publish(device)
 
         if request.is_ajax():
             return HttpResponse()
@@ -117,6 +120,44 @@ def gpu_info(request):
     return HttpResponse(json.dumps(return_data, indent=4))
 
 
+@login_required_ajax
+def gpu_status(request):
+    """
+    Returns the status of all GPUs of the requested devices, or of all devices the user may use if no device is
+    requested, with a fixed number of queries.
+    """
+    if request.method != "GET" or not request.is_ajax():
+        raise SuspiciousOperation
+
+    device_names = set(request.GET.getlist('device_name'))
+    if device_names:
+        devices = Device.objects.filter(name__in=device_names)
+    else:
+        devices = Device.objects.usable_by(request.user)
+    devices = list(devices.prefetch_related(Prefetch("gpus", queryset=GPU.objects.with_reservations())))
+    if device_names and {device.name for device in devices} != device_names:
+        raise Http404
+    if not all(device.can_be_used_by(request.user) for device in devices):
+        raise PermissionDenied
+
+    return_data = {'devices': []}
+    for device in devices:
+        gpus = []
+        for gpu in device.gpus.all():
+            reservations = gpu.ordered_reservations()
+            gpus.append({
+                "id": gpu.uuid,
+                "name": gpu.model_name,
+                "used": gpu.used_memory,
+                "total": gpu.total_memory,
+                "user": reservations[0].user.username if reservations else "No current user",
+                "queue_length": max(len(reservations) - 1, 0),
+            })
+        return_data['devices'].append({"name": device.name, "gpus": gpus})
+
+    return HttpResponse(json.dumps(return_data))
+
+
 @login_required
 def gpu_done(request, gpu_id):
     gpu = get_object_or_404(GPU, pk=gpu_id)
@@ -127,15 +168,12 @@ def gpu_done(request, gpu_id):
     if not gpu.device.can_be_used_by(request.user):
         raise PermissionDenied
 
-    current_reservation = gpu.current_reservation()
-
-    if current_reservation is None:
+    try:
+        queue = finish_reservation(gpu, request.user)
+    except Reservation.DoesNotExist:
         raise Http404
 
-    if current_reservation.user != request.user:
-        raise PermissionDenied
-
-    delete_reservation(current_reservation)
+    reservation_ended(gpu, queue)
 
     return HttpResponse()
 
@@ -150,18 +188,12 @@ def gpu_extend(request, gpu_id):
     if not gpu.device.can_be_used_by(request.user):
         raise PermissionDenied
 
-    current_reservation = gpu.current_reservation()
-
-    if current_reservation is None:
+    try:
+        extend_reservation(gpu, request.user)
+    except Reservation.DoesNotExist:
         raise Http404
 
-    if current_reservation.user != request.user:
-        raise PermissionDenied
-
-    if not current_reservation.extend():
-        raise SuspiciousOperation
-
-    publish_device_state(current_reservation.gpu.device)
+    schedule_device_publish(gpu.device)
 
     return HttpResponse()
 
@@ -176,17 +208,40 @@ def gpu_cancel(request, gpu_id):
         raise PermissionDenied
 
     try:
-        reservation = gpu.reservations.filter(user=request.user).latest("time_reserved")
-        if reservation == gpu.get_current_reservation():
-            raise SuspiciousOperation
-        reservation.delete()
-        publish_device_state(gpu.device)
+        cancel_reservation(gpu, request.user)
+        schedule_device_publish(gpu.device)
     except ObjectDoesNotExist as e:
         raise Http404
 
     return HttpResponse()
 
 
+@csrf_exempt
+def push_gpu_info(request, device_name):
+    if request.method != "POST":
+        raise SuspiciousOperation
+
+    device = get_object_or_404(Device, name=device_name)
+
+    # the device_query agent authenticates with the push token of its device: "Authorization: Token <push token>"
+    authorization = request.META.get("HTTP_AUTHORIZATION", "").split()
+    if len(device.push_token) == 0 or len(authorization) != 2 or authorization[0] != "Token" \
+            or not hmac.compare_digest(authorization[1].encode("utf-8"), device.push_token.encode("utf-8")):
+        return HttpResponseForbidden()
+
+    try:
+        gpus = decode_gpu_info(request.body, request.content_type, request.META.get("HTTP_CONTENT_ENCODING"))
+        changed = apply_gpu_info(device, gpus)
+    except (KeyError, TypeError, ValueError, OSError):
+        return HttpResponseBadRequest()
+
+    # pushes that only confirm the stored state are published by the GPU daemon together with all other devices
+    if changed:
+        schedule_device_publish(device)
+
+    return HttpResponse()
+
+
 @login_required
 @render_to("send_message.html")
 def send_message(request):
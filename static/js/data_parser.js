@@ -59,6 +59,19 @@ function updateGPUData(data, currentUser) {
     }
 }
 
+function mergeGPUDelta(device, gpuDeltas) {
+    // merges the changed fields of some GPUs into the cached device data and returns the updated GPUs
+    const changedGPUs = [];
+    for (const gpuDelta of gpuDeltas) {
+        const gpu = device.gpus.find(gpu => gpu.uuid === gpuDelta.uuid);
+        if (gpu !== undefined) {
+            Object.assign(gpu, gpuDelta);
+            changedGPUs.push(gpu);
+        }
+    }
+    return changedGPUs;
+}
+
 function setupActionButtons() {
     $(".action-button").on('click', function (){
         const $this = $(this);
@@ -105,30 +118,51 @@ function setupModals() {
     });
 }
 
-function setupWebsockets(deviceNames, currentUser) {
-    for (const device of deviceNames) {
-         const socket = new ReconnectingWebSocket(webSocketMethod + "://" + window.location.host + '/ws/device/' + device + '/');
-         socket.device_name = device;
-         socket.addEventListener('open', function (event) {
-             console.log("Opening Socket " + socket.device_name);
-         });
-         socket.addEventListener('close', function (event) {
-             console.log("Closing socket " + socket.device_name);
-             delete deviceData[socket.device_name];
-         });
-         socket.addEventListener('error', function (event) {
-             console.log("Error while opening Websocket" + event);
-         });
-         socket.addEventListener('message', function (event) {
-             const data = JSON.parse(event.data);
-             deviceData[socket.device_name] = data;
-             updateGPUData(data, currentUser);
-         });
-     }
+function setupInitialState(initialState, currentUser) {
+    for (const data of initialState.devices) {
+        deviceData[data.name] = data;
+        updateGPUData(data, currentUser);
+    }
+}
+
+function setupWebsocket(currentUser, knownVersions) {
+    // a single socket receives the state of all devices the user may use, each message names its device
+    const url = webSocketMethod + "://" + window.location.host + '/ws/devices/';
+    // states that are already known are not sent again on the first connect
+    const socket = new ReconnectingWebSocket(url + '?versions=' + encodeURIComponent(JSON.stringify(knownVersions)));
+    socket.addEventListener('open', function (event) {
+        console.log("Opening Socket");
+        // updates may have been missed while a socket was closed, so a reconnect fetches the full state
+        socket.url = url;
+    });
+    socket.addEventListener('close', function (event) {
+        console.log("Closing socket");
+        for (const deviceName of Object.keys(deviceData)) {
+            delete deviceData[deviceName];
+        }
+    });
+    socket.addEventListener('error', function (event) {
+        console.log("Error while opening Websocket" + event);
+    });
+    socket.addEventListener('message', function (event) {
+        const data = JSON.parse(event.data);
+        if (data.delta) {
+            if (!(data.name in deviceData)) {
+                // the full state is sent as soon as the socket is (re)connected
+                return;
+            }
+            updateGPUData({gpus: mergeGPUDelta(deviceData[data.name], data.gpus)}, currentUser);
+        } else {
+            deviceData[data.name] = data;
+            updateGPUData(data, currentUser);
+        }
+    });
 }
 
-export default function(deviceNames, currentUser) {
-    setupWebsockets(deviceNames, currentUser);
+export default function(currentUser) {
+    const initialState = JSON.parse(document.getElementById('initial-state').textContent);
+    setupInitialState(initialState, currentUser);
+    setupWebsocket(currentUser, initialState.versions);
     setupActionButtons();
     setupModals();
 }
@@ -15,6 +15,8 @@ urlpatterns = [
     path('gpu/<int:gpu_id>/cancel', views.gpu_cancel, name="cancel_gpu"),
     path('gpu/<int:gpu_id>/extend', views.gpu_extend, name="extend_gpu"),
     path('gpu/info', views.gpu_info, name="gpu_info"),
+    path('gpu/status', views.gpu_status, name="gpu_status"),
+    path('device/<device_name>/push', views.push_gpu_info, name="push_gpu_info"),
 
     path('accounts/login', auth_views.LoginView.as_view(template_name='login.html')),
     path('login/', auth_views.LoginView.as_view(template_name='login.html')),